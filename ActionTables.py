@@ -0,0 +1,148 @@
+import os
+
+import melee
+import numpy as np
+
+import MovesList
+
+# Lookup tables answering the framedata and MovesList questions the feature code asks every frame.
+# Per action tables are indexed by Action.value, per character tables by [Character.value, Action.value].
+# Action.UNKNOWN_ANIMATION is 0xFFFF, so every value past the last real action shares one slot (see slot()).
+#
+# The framedata tables are built from melee.FrameData once and cached in cache/, which saves parsing
+# framedata.csv on every start. Scalar lookups go through python list copies of the tables, which index
+# faster than numpy arrays.
+
+table_version = 1
+
+unknown_slot = max(a.value for a in melee.Action if a != melee.Action.UNKNOWN_ANIMATION) + 1
+action_slots = unknown_slot + 1
+character_slots = max(c.value for c in melee.Character) + 1
+
+cache_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache')
+cache_path = os.path.join(cache_folder, f'action_tables_v{table_version}_melee_{melee.version.__version__}.npz')
+
+
+def slot(action):
+    """Table index of an Action, an Action.value or an array of Action.values"""
+    if isinstance(action, melee.Action):
+        action = action.value
+    if isinstance(action, np.ndarray):
+        return np.minimum(action, unknown_slot)
+    return action if action < unknown_slot else unknown_slot
+
+
+def _action_set(actions: list) -> np.ndarray:
+    table = np.zeros(action_slots, dtype=bool)
+    for a in actions:
+        table[slot(a)] = True
+    return table
+
+
+def _build() -> dict:
+    framedata = melee.FrameData()
+    attack = np.zeros((character_slots, action_slots), dtype=bool)
+    bmove = np.zeros((character_slots, action_slots), dtype=bool)
+    first_hitbox = np.full((character_slots, action_slots), -1, dtype=np.int16)
+    last_hitbox = np.full((character_slots, action_slots), -1, dtype=np.int16)
+
+    for character in melee.Character:
+        for action in melee.Action:
+            i = character.value, slot(action)
+            bmove[i] = framedata.is_bmove(character, action)
+            if character in framedata.framedata and action in framedata.framedata[character]:
+                attack[i] = framedata.is_attack(character, action)
+                first_hitbox[i] = framedata.first_hitbox_frame(character, action)
+                last_hitbox[i] = framedata.last_hitbox_frame(character, action)
+
+    return {'attack': attack, 'bmove': bmove, 'first_hitbox': first_hitbox, 'last_hitbox': last_hitbox}
+
+
+def _load() -> dict:
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    tables = _build()
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, **tables)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print('Could not cache action tables', e)
+    return tables
+
+
+_tables = _load()
+
+attack_table: np.ndarray = _tables['attack']
+bmove_table: np.ndarray = _tables['bmove']
+first_hitbox_table: np.ndarray = _tables['first_hitbox']
+last_hitbox_table: np.ndarray = _tables['last_hitbox']
+
+# The MovesList sets are cheap to build, so they are not cached and always follow edits to MovesList
+dead_table = _action_set(MovesList.dead_list)
+special_fall_table = _action_set(MovesList.special_fall_list)
+firefoxing_table = _action_set(MovesList.firefoxing)
+lying_table = _action_set(MovesList.lying)
+tumbling_table = _action_set([melee.Action.TUMBLING])
+
+_attack = attack_table.tolist()
+_bmove = bmove_table.tolist()
+_first_hitbox = first_hitbox_table.tolist()
+_last_hitbox = last_hitbox_table.tolist()
+_dead = dead_table.tolist()
+_special_fall = special_fall_table.tolist()
+_firefoxing = firefoxing_table.tolist()
+_lying = lying_table.tolist()
+_tumbling = tumbling_table.tolist()
+
+
+def is_attack(character: melee.Character, action: melee.Action) -> bool:
+    return _attack[character.value][slot(action.value)]
+
+
+def is_bmove(character: melee.Character, action: melee.Action) -> bool:
+    return _bmove[character.value][slot(action.value)]
+
+
+def attack_state(character: melee.Character, action: melee.Action, action_frame: int) -> melee.AttackState:
+    i = slot(action.value)
+    if not _attack[character.value][i]:
+        return melee.AttackState.NOT_ATTACKING
+    if action_frame < _first_hitbox[character.value][i]:
+        return melee.AttackState.WINDUP
+    if action_frame > _last_hitbox[character.value][i]:
+        return melee.AttackState.COOLDOWN
+    return melee.AttackState.ATTACKING
+
+
+def is_dead(action: melee.Action) -> bool:
+    return _dead[slot(action.value)]
+
+
+def is_special_fall(action: melee.Action) -> bool:
+    return _special_fall[slot(action.value)]
+
+
+def is_firefoxing(action: melee.Action) -> bool:
+    return _firefoxing[slot(action.value)]
+
+
+def is_lying(action: melee.Action) -> bool:
+    return _lying[slot(action.value)]
+
+
+def is_tumbling(action: melee.Action) -> bool:
+    return _tumbling[slot(action.value)]
+
+
+def attack_state_batch(character: np.ndarray, action: np.ndarray, action_frame: np.ndarray) -> np.ndarray:
+    """attack_state over arrays of Character.value, Action.value and action_frame, as AttackState.value"""
+    i = character, slot(action)
+    state = np.full(len(action), melee.AttackState.ATTACKING.value, dtype=np.uint8)
+    state[action_frame > last_hitbox_table[i]] = melee.AttackState.COOLDOWN.value
+    state[action_frame < first_hitbox_table[i]] = melee.AttackState.WINDUP.value
+    state[~attack_table[i]] = melee.AttackState.NOT_ATTACKING.value
+    return state
@@ -2,6 +2,7 @@ import argparse
 import platform
 
 import GameManager
+import Workers
 
 dolphin_path = ''
 if platform.system() == "Darwin":
@@ -11,8 +12,6 @@ elif platform.system() == "Windows":
 elif platform.system() == "Linux":
     dolphin_path = "/home/human/.config/Slippi Launcher/netplay/squashfs-root/usr/bin"
 
-print(dolphin_path)
-
 
 def check_port(value):
     ivalue = int(value)
@@ -46,6 +45,54 @@ def get_args():
     parser.add_argument('--compete', default=False, action='store_true')
     parser.add_argument('--cpu_level', default=0, type=int)
     parser.add_argument('--wandb', default=False, action='store_true')
+    parser.add_argument('--workers', default=Workers.default_workers(), type=int,
+                        help='Worker processes used to load replays')
+    parser.add_argument('--replay_timeout', default=300, type=float,
+                        help='Seconds a single replay may take to load before it is skipped. With --workers 1 '
+                             '(or --profile) it needs SIGALRM, so it is not enforced on Windows')
+    parser.add_argument('--frame_cache', default='frame_cache', type=str,
+                        help='Folder parsed replay frames are cached in, empty to always parse the replay')
+    parser.add_argument('--chunk_rows', default=1 << 18, type=int,
+                        help='Rows generate_data.py buffers before writing them out as a shard, bounds its memory')
+    parser.add_argument('--rebuild_features', default=False, action='store_true',
+                        help='generate_data.py only recomputes the feature columns whose definition changed')
+    parser.add_argument('--compact_step', default=1e-3, type=float,
+                        help='compact_data.py merges samples whose observations round to the same multiple of this')
+    parser.add_argument('--lr', default=5e-5, type=float, help='Learning rate')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--epochs', default=1, type=int)
+    parser.add_argument('--validation_split', default=0.1, type=float,
+                        help='Fraction of the dataset, taken from the end, held out for validation')
+    parser.add_argument('--shuffle_buffer', default=1 << 16, type=int,
+                        help='Rows held in the training shuffle buffer')
+    parser.add_argument('--normalize', default=False, action='store_true',
+                        help='Train on features standardized with the dataset\'s stats.json, folded into the '
+                             'first layer')
+    parser.add_argument('--train_workers', default=0, type=int,
+                        help='Models train_all.py trains at once, 0 picks one per two cores')
+    parser.add_argument('--replay', default='', type=str,
+                        help='Replay benchmark_bot.py feeds to the bot, which plays its first port')
+    parser.add_argument('--latency_log', default='latency', type=str,
+                        help='Per frame latency is written to <latency_log>.json/.csv on ^C, empty to skip')
+    parser.add_argument('--inference', default='numpy', choices=['numpy', 'keras'],
+                        help='Backend the bot runs the model with')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='Precision the numpy backend\'s model artifact is stored in, widened to float32 on load. '
+                             'See quantize_models.py')
+    parser.add_argument('--self_play', default=False, action='store_true',
+                        help='duel.py plays the opponent port with a second bot instead of a CPU')
+    parser.add_argument('--pipeline', default=False, action='store_true',
+                        help='Decide moves on a worker thread while the next gamestate is polled')
+    parser.add_argument('--late_policy', default='reuse', choices=['drop', 'reuse', 'late'],
+                        help='What the pipelined loop does when a move is not ready in time')
+    parser.add_argument('--pipeline_wait', default=0.002, type=float,
+                        help='Seconds the pipelined loop waits for a move after the gamestate arrived')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='generate_data.py and duel.py add up the time of every stage and profile the run')
+    parser.add_argument('--profiler', default='sample', choices=['sample', 'cprofile', 'none'],
+                        help='Profiler --profile runs alongside the stage timers')
+    parser.add_argument('--profile_output', default='profile', type=str,
+                        help='--profile writes <profile_output>.json and .stacks (sample) or .prof (cprofile)')
 
     args: GameManager.Args = parser.parse_args()
     return args
\ No newline at end of file
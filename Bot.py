@@ -1,23 +1,27 @@
-import keras
 import melee
 
 from DataHandler import generate_input, generate_output, decode_from_model
 import numpy as np
 
+import ActionTables
 import MovesList
+import Timing
 
 
 class Bot:
-    def __init__(self, model, controller: melee.Controller, opponent_controller: melee.Controller):
+    def __init__(self, model, controller: melee.Controller, opponent_controller: melee.Controller,
+                 timer: Timing.FrameTimer = None):
         self.opponent_controller = opponent_controller
         self.drop_every = 180
-        self.model: keras.Model = model
+        # Anything with a keras style predict: a keras model, an Inference.NumpyModel or a BrokerClient
+        self.model = model
         self.controller = controller
         self.frame_counter = 0
 
         self.delay = 0
         self.pause_delay = 0
         self.firefoxing = False
+        self.timer = timer if timer is not None else Timing.FrameTimer()
 
     def validate_action(self, action, gamestate: melee.GameState, port: int, opponent_port: int):
         # global smash_last
@@ -31,11 +35,11 @@ class Bot:
         x = np.sign(player.position.x)
         rel_x = np.sign(player.position.x - opponent.position.x)
         print(x, player.moonwalkwarning, player.action)
-        if player.action in MovesList.special_fall_list:
+        if ActionTables.is_special_fall(player.action):
             print('special falling')
             return [[0, 0, 0, 0, 0], -x, 0, 0, 0]
 
-        if player.action in MovesList.lying:
+        if ActionTables.is_lying(player.action):
             print('getting up')
             return [[0, 0, 0, 0, 0], rel_x, 0, 0, 0]
 
@@ -64,7 +68,7 @@ class Bot:
         if player.character in [melee.Character.FOX, melee.Character.FALCO]:
             if player.y < -20:
                 print('auto firefoxing')
-                if player.action in MovesList.firefoxing:
+                if ActionTables.is_firefoxing(player.action):
                     self.firefoxing = True
                 if not self.firefoxing:
                     print(player.action)
@@ -79,29 +83,54 @@ class Bot:
         return action
 
     def act(self, gamestate: melee.GameState):
+        start = self.timer.start()
+        self.apply(self.decide(gamestate))
+        self.timer.lap('act', start)
+
+    def apply(self, commands: list):
+        """Runs the controller commands decide returned, e.g. [('press_button', b), ('flush',)]"""
+        for name, *params in commands:
+            if name == 'flush':
+                t = self.timer.start()
+                self.controller.flush()
+                self.timer.lap('flush', t)
+            else:
+                getattr(self.controller, name)(*params)
+
+    def decide(self, gamestate: melee.GameState) -> list:
+        """
+        Works out this frame's move and returns it as controller commands for apply. Only decide touches the
+        bot's state and only apply touches the controller, so decide can run on another thread.
+        """
+        commands = []
         if self.delay > 0:
             self.delay -= 1
-            return
+            return commands
         if self.pause_delay > 0:
             self.pause_delay -= 1
-            self.controller.release_all()
-            return
-        self.controller.release_all()
+            commands.append(('release_all',))
+            return commands
+        commands.append(('release_all',))
 
         player: melee.PlayerState = gamestate.players.get(self.controller.port)
         opponent: melee.PlayerState = gamestate.players.get(self.opponent_controller.port)
 
-        if opponent.action in MovesList.dead_list and player.on_ground:
-            return
+        if ActionTables.is_dead(opponent.action) and player.on_ground:
+            return commands
 
         self.frame_counter += 1
 
+        t = self.timer.start()
         inp = generate_input(gamestate, self.controller.port, self.opponent_controller.port)
+        t = self.timer.lap('generate_input', t)
         a = self.model.predict(np.array([inp]), verbose=0, use_multiprocessing=True)
+        t = self.timer.lap('inference', t)
 
         a, action = decode_from_model(a, player, gamestate.stage)
+        t = self.timer.lap('decode_from_model', t)
 
         action = self.validate_action(action, gamestate, self.controller.port, self.opponent_controller.port)
+        self.timer.lap('validate_action', t)
         b = melee.enums.Button
 
         print(action)
@@ -109,16 +138,16 @@ class Bot:
         for i in range(len(MovesList.buttons)):
             if action[0][i] == 1:
                 button_used = True
-                self.controller.press_button(MovesList.buttons[i][0])
+                commands.append(('press_button', MovesList.buttons[i][0]))
             else:
-                self.controller.release_button(MovesList.buttons[i][0])
+                commands.append(('release_button', MovesList.buttons[i][0]))
 
         if action[0][0] == 1:  # jump
-            self.controller.tilt_analog_unit(melee.Button.BUTTON_MAIN, 0, 0)
-            self.controller.tilt_analog_unit(melee.Button.BUTTON_C, 0, 0)
+            commands.append(('tilt_analog_unit', melee.Button.BUTTON_MAIN, 0, 0))
+            commands.append(('tilt_analog_unit', melee.Button.BUTTON_C, 0, 0))
         else:
-            self.controller.tilt_analog_unit(melee.Button.BUTTON_MAIN, action[-4], action[-3])
-            self.controller.tilt_analog_unit(melee.Button.BUTTON_C, action[-2], action[-1])
+            commands.append(('tilt_analog_unit', melee.Button.BUTTON_MAIN, action[-4], action[-3]))
+            commands.append(('tilt_analog_unit', melee.Button.BUTTON_C, action[-2], action[-1]))
 
 
 
@@ -132,9 +161,10 @@ class Bot:
 
 
 
-        self.controller.flush()
+        commands.append(('flush',))
 
         if self.frame_counter >= self.drop_every:
-            self.controller.release_all()
+            commands.append(('release_all',))
             self.frame_counter = 0
             self.delay += 1
+        return commands
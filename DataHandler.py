@@ -1,56 +1,42 @@
+import threading
+
 import numpy as np
 import melee
-from tensorflow import keras
 
+import ActionTables
 import MovesList
 
-framedata = melee.FrameData()
-
 low_analog = 0.2
 high_analog = 0.8
 
+# Action ids returned by generate_output and decoded by decode_from_model
+output_names = ['jump', 'shield', 'grab',
+                'c_left', 'c_right', 'c_down', 'c_up',
+                'move_left', 'move_right', 'move_down', 'move_up',
+                'b_left', 'b_right', 'b_down', 'b_up', 'b_neutral',
+                'a_left', 'a_right', 'a_down', 'a_up', 'a_neutral']
 
-def controller_states_different(new_player: melee.PlayerState, old_player: melee.PlayerState):
-    new: melee.ControllerState = new_player.controller_state
-    old: melee.ControllerState = old_player.controller_state
-
-    # if generate_output(new_player) == generate_output(old_player):
-    #     return False
-
-    for btns in MovesList.buttons:
-        # for b in melee.enums.Button:
-        for b in btns:
-            if new.button.get(b) != old.button.get(b) and new.button.get(b):
-                return True
-
-    if new.c_stick[0] < low_analog and old.c_stick[0] >= low_analog:
-        return True
-
-    if new.c_stick[0] > high_analog and old.c_stick[0] <= high_analog:
-        return True
-
-    if new.c_stick[1] < low_analog and old.c_stick[1] >= low_analog:
-        return True
-
-    if new.c_stick[1] > high_analog and old.c_stick[1] <= high_analog:
-        return True
-
-    if new.main_stick[0] < low_analog and old.main_stick[0] >= low_analog:
-        return True
 
-    if new.main_stick[0] > high_analog and old.main_stick[0] <= high_analog:
-        return True
+def controller_states_different(new_player, old_player):
+    """
+    True when a button got pressed or a stick crossed low_analog/high_analog between old_player and
+    new_player. Either can be a PlayerState or a PlayerSnapshot, so callers can keep snapshots around instead
+    of whole PlayerStates. Only the controller fields are read, nothing is copied.
+    """
+    new_buttons, *new_axes = _controller_fields(new_player)
+    old_buttons, *old_axes = _controller_fields(old_player)
 
-    if new.main_stick[1] < low_analog and old.main_stick[1] >= low_analog:
+    if new_buttons & ~old_buttons:
         return True
 
-    if new.main_stick[1] > high_analog and old.main_stick[1] <= high_analog:
-        return True
+    for new, old in zip(new_axes, old_axes):
+        if new < low_analog and old >= low_analog:
+            return True
+        if new > high_analog and old <= high_analog:
+            return True
 
     return False
 
-    # return generate_output(new) != generate_output(old)
-
 
 def get_ports(gamestate: melee.GameState, player_character: melee.Character, opponent_character: melee.Character):
     if gamestate is None:
@@ -77,84 +63,286 @@ def get_ports(gamestate: melee.GameState, player_character: melee.Character, opp
 
 
 def get_player_obs(player: melee.PlayerState, gamestate: melee.GameState) -> list:
-    x = player.position.x / 100
-    y = player.position.y / 50
-    shield = player.shield_strength / 60
-
-    percent = player.percent / 100
-    vel_y = (player.speed_y_self + player.speed_y_attack)
-    vel_x = (player.speed_x_attack + player.speed_air_x_self + player.speed_ground_x_self)
-    is_attacking = 1 if framedata.is_attack(player.character, player.action) else 0
-
-    # return [x, y, shield, percent, vel_x, vel_y, is_attacking]
-    edge = melee.EDGE_POSITION.get(gamestate.stage)
-
-    offstage = 1 if abs(player.position.x) > edge - 1 else 0
-    tumbling = 1 if player.action in [melee.Action.TUMBLING] else 0
-    on_ground = 1 if player.on_ground else 0
-
-    facing = 1 if player.facing else -1
-    # return [x, y, percent, shield, is_attacking, on_ground, vel_x, vel_y, facing]
-    in_hitstun = 1 if player.hitlag_left else 0
-    is_invulnerable = 1 if player.invulnerable else 0
-
-    special_fall = 1 if player.action in MovesList.special_fall_list else 0
-    is_dead = 1 if player.action in MovesList.dead_list else 0
-
-    jumps_left = 1 if player.jumps_left > 0 else 0
-
-    attack_state = framedata.attack_state(player.character, player.action, player.action_frame)
-    attack_active = 1 if attack_state == melee.AttackState.ATTACKING else 0
-    attack_cooldown = 1 if attack_state == melee.AttackState.COOLDOWN else 0
-    attack_windup = 1 if attack_state == melee.AttackState.WINDUP else 0
-
-    is_bmove = 1 if framedata.is_bmove(player.character, player.action) else 0
-
-    stock = player.stock
-    return [
-        tumbling,
-        offstage,
-        special_fall,
-        # is_dead,
-        shield, on_ground, is_attacking,
-        x, y,
-        vel_x, vel_y,
-        # percent,
-        facing,
-        in_hitstun,
-        is_invulnerable,
-        jumps_left,
-        # attack_windup, attack_active, attack_cooldown,
-        # is_bmove,
-        (abs(player.position.x) - edge) / 20,
-        # stock
-    ]
+    """The player_obs_names columns for one player, from the scalar side of player_feature_library"""
+    return [player_feature_library[name][2](player, gamestate.stage) for name in player_obs_names]
 
 
 def generate_input(gamestate: melee.GameState, player_port: int, opponent_port: int):
+    """
+    The input_names observation for one frame, computed by the scalar side of input_features. This is the
+    per frame path of the bot, check_parity.py checks it against generate_input_batch.
+    """
     player: melee.PlayerState = gamestate.players.get(player_port)
     opponent: melee.PlayerState = gamestate.players.get(opponent_port)
     if player is None or opponent is None:
         return None
 
-    direction = 1 if player.position.x < opponent.position.x else -1
-
-    firefoxing = 1 if player.character in [melee.Character.FOX,
-                                           melee.Character.FALCO] and player.action in MovesList.firefoxing else 0
+    stage = gamestate.stage
+    obs = np.empty(len(input_features))
+    for i, feature in enumerate(input_features):
+        obs[i] = feature.scalar(player, opponent, stage)
+    return obs
+
+
+# libmelee hands out numpy float32 scalars. Depending on the numpy version, float32 scalar <op> python number
+# is computed in float32 (numpy >= 2) or float64, so the features promote their float32 columns the same
+# way before mixing them with python numbers. That keeps them bit identical to the old per frame code.
+_scalar_float = type(np.float32(1) / 1)
+
+
+# PlayerState fields read by the features, as (column name, dtype). player_columns stores one array per field
+# covering every frame of a replay so the features below can be computed for all of them at once.
+player_fields = [
+    ('x', np.float32), ('y', np.float32), ('shield_strength', np.float32),
+    ('speed_y_self', np.float32), ('speed_y_attack', np.float32),
+    ('speed_x_attack', np.float32), ('speed_air_x_self', np.float32), ('speed_ground_x_self', np.float32),
+    ('character', np.uint8), ('action', np.uint16), ('action_frame', np.int16),
+    ('on_ground', np.bool_), ('facing', np.bool_), ('hitlag_left', np.int16), ('invulnerable', np.bool_),
+    ('jumps_left', np.uint8),
+    # Controller state read by generate_output and controller_states_different. The sticks are stored in the
+    # type libmelee computes them in, so comparing them against low_analog/high_analog rounds the same way.
+    ('buttons', np.uint8), ('main_x', _scalar_float), ('main_y', _scalar_float),
+    ('c_x', _scalar_float), ('c_y', _scalar_float),
+]
+
+# Bit i of the buttons column is set when button_bits[i] is pressed
+button_bits = [b for buttons in MovesList.buttons for b in buttons]
+
+
+def _promote(column: np.ndarray) -> np.ndarray:
+    return column.astype(_scalar_float, copy=False)
+
+
+def _player_field(player: melee.PlayerState, name: str):
+    if name == 'x':
+        return player.position.x
+    if name == 'y':
+        return player.position.y
+    if name in ['character', 'action']:
+        return getattr(player, name).value
+    controller: melee.ControllerState = player.controller_state
+    if name == 'buttons':
+        return sum(1 << i for i, b in enumerate(button_bits) if controller.button.get(b))
+    if name == 'main_x':
+        return controller.main_stick[0]
+    if name == 'main_y':
+        return controller.main_stick[1]
+    if name == 'c_x':
+        return controller.c_stick[0]
+    if name == 'c_y':
+        return controller.c_stick[1]
+    return getattr(player, name)
 
-    obs = [
-        (player.position.x - opponent.position.x) / 20, (player.position.y - opponent.position.y) / 10,
-        firefoxing,
-        direction,
-        1 if player.position.x > opponent.position.x else -1,
-        1 if player.position.y > opponent.position.y else -1,
 
-        abs(player.position.x - opponent.position.x) - 3.5
-    ]
-    obs += get_player_obs(player, gamestate)
-    obs += get_player_obs(opponent, gamestate)
+class PlayerSnapshot:
+    """
+    The player_fields of one PlayerState in plain slots. Holding on to one doesn't keep the PlayerState, its
+    ControllerState and the GameState they belong to alive.
+    """
+    __slots__ = [name for name, _ in player_fields]
 
-    return np.array(obs).flatten()
+    def __init__(self, player: melee.PlayerState):
+        for name in self.__slots__:
+            setattr(self, name, _player_field(player, name))
+
+
+def snapshot(player) -> PlayerSnapshot:
+    return player if isinstance(player, PlayerSnapshot) else PlayerSnapshot(player)
+
+
+# The player_fields controller_states_different compares, buttons first
+controller_fields = ['buttons', 'c_x', 'c_y', 'main_x', 'main_y']
+
+
+def _controller_fields(player) -> list:
+    if isinstance(player, PlayerSnapshot):
+        return [getattr(player, name) for name in controller_fields]
+    return [_player_field(player, name) for name in controller_fields]
+
+
+class ColumnRecorder:
+    """
+    Collects the player_fields of one player frame by frame without keeping the PlayerStates around. Values
+    go straight into typed arrays that grow as needed, so a long replay doesn't leave millions of python
+    objects for the garbage collector to track.
+    """
+
+    def __init__(self, capacity: int = 1 << 12):
+        self.size = 0
+        self.fields = {name: np.empty(max(capacity, 1), dtype=dtype) for name, dtype in player_fields}
+
+    def __len__(self):
+        return self.size
+
+    def append(self, player: melee.PlayerState):
+        if self.size == len(self.fields['x']):
+            for name, column in self.fields.items():
+                self.fields[name] = np.concatenate([column, np.empty_like(column)])
+        for name, column in self.fields.items():
+            column[self.size] = _player_field(player, name)
+        self.size += 1
+
+    def columns(self) -> dict:
+        return {name: column[:self.size].copy() for name, column in self.fields.items()}
+
+
+def player_columns(players: list) -> dict:
+    """Turns a list of per-frame PlayerStates into {field: array over frames}"""
+    recorder = ColumnRecorder(len(players))
+    for player in players:
+        recorder.append(player)
+    return recorder.columns()
+
+
+class Feature:
+    """
+    One named column of generate_input. compute(player, opponent, stage) gets the player_columns of both
+    players and returns the column for every frame, scalar(player, opponent, stage) gets the PlayerStates of one
+    frame and returns its value. Both must give the same numbers (check_parity.py compares them). Bump version
+    whenever they change: datasets record the version of every column they hold, and
+    generate_data.py --rebuild_features recomputes the ones that differ.
+    """
+
+    def __init__(self, name: str, version: int, compute, scalar):
+        self.name = name
+        self.version = version
+        self.compute = compute
+        self.scalar = scalar
+
+
+def _edge(stage: melee.Stage):
+    return melee.EDGE_POSITION.get(stage)
+
+
+def _action(player: dict) -> np.ndarray:
+    return ActionTables.slot(player['action'])
+
+
+def _attack_state(player: dict) -> np.ndarray:
+    return ActionTables.attack_state_batch(player['character'], player['action'], player['action_frame'])
+
+
+def _attack_state_of(player: melee.PlayerState) -> melee.AttackState:
+    return ActionTables.attack_state(player.character, player.action, player.action_frame)
+
+
+# Features of a single player as name: (version, compute(player, stage), scalar(player, stage)), see Feature.
+# player_obs_names picks the ones that are used, once for the player and once for the opponent. The rest are
+# kept around for experiments.
+player_feature_library = {
+    'tumbling': (1, lambda p, stage: ActionTables.tumbling_table[_action(p)],
+                 lambda p, stage: 1 if ActionTables.is_tumbling(p.action) else 0),
+    'offstage': (1, lambda p, stage: _promote(np.abs(p['x'])) > _edge(stage) - 1,
+                 lambda p, stage: 1 if abs(p.position.x) > _edge(stage) - 1 else 0),
+    'special_fall': (1, lambda p, stage: ActionTables.special_fall_table[_action(p)],
+                     lambda p, stage: 1 if ActionTables.is_special_fall(p.action) else 0),
+    'is_dead': (1, lambda p, stage: ActionTables.dead_table[_action(p)],
+                lambda p, stage: 1 if ActionTables.is_dead(p.action) else 0),
+    'shield': (1, lambda p, stage: _promote(p['shield_strength']) / 60,
+               lambda p, stage: p.shield_strength / 60),
+    'on_ground': (1, lambda p, stage: p['on_ground'],
+                  lambda p, stage: 1 if p.on_ground else 0),
+    'is_attacking': (1, lambda p, stage: ActionTables.attack_table[p['character'], _action(p)],
+                     lambda p, stage: 1 if ActionTables.is_attack(p.character, p.action) else 0),
+    'x': (1, lambda p, stage: _promote(p['x']) / 100,
+          lambda p, stage: p.position.x / 100),
+    'y': (1, lambda p, stage: _promote(p['y']) / 50,
+          lambda p, stage: p.position.y / 50),
+    'vel_x': (1, lambda p, stage: p['speed_x_attack'] + p['speed_air_x_self'] + p['speed_ground_x_self'],
+              lambda p, stage: p.speed_x_attack + p.speed_air_x_self + p.speed_ground_x_self),
+    'vel_y': (1, lambda p, stage: p['speed_y_self'] + p['speed_y_attack'],
+              lambda p, stage: p.speed_y_self + p.speed_y_attack),
+    'facing': (1, lambda p, stage: np.where(p['facing'], 1, -1),
+               lambda p, stage: 1 if p.facing else -1),
+    'in_hitstun': (1, lambda p, stage: p['hitlag_left'] != 0,
+                   lambda p, stage: 1 if p.hitlag_left else 0),
+    'is_invulnerable': (1, lambda p, stage: p['invulnerable'],
+                        lambda p, stage: 1 if p.invulnerable else 0),
+    'jumps_left': (1, lambda p, stage: p['jumps_left'] > 0,
+                   lambda p, stage: 1 if p.jumps_left > 0 else 0),
+    'attack_windup': (1, lambda p, stage: _attack_state(p) == melee.AttackState.WINDUP.value,
+                      lambda p, stage: 1 if _attack_state_of(p) == melee.AttackState.WINDUP else 0),
+    'attack_active': (1, lambda p, stage: _attack_state(p) == melee.AttackState.ATTACKING.value,
+                      lambda p, stage: 1 if _attack_state_of(p) == melee.AttackState.ATTACKING else 0),
+    'attack_cooldown': (1, lambda p, stage: _attack_state(p) == melee.AttackState.COOLDOWN.value,
+                        lambda p, stage: 1 if _attack_state_of(p) == melee.AttackState.COOLDOWN else 0),
+    'is_bmove': (1, lambda p, stage: ActionTables.bmove_table[p['character'], _action(p)],
+                 lambda p, stage: 1 if ActionTables.is_bmove(p.character, p.action) else 0),
+    'edge_distance': (1, lambda p, stage: (_promote(np.abs(p['x'])) - _edge(stage)) / 20,
+                      lambda p, stage: (abs(p.position.x) - _edge(stage)) / 20),
+}
+
+# Column names of get_player_obs, in order
+player_obs_names = ['tumbling', 'offstage', 'special_fall', 'shield', 'on_ground', 'is_attacking', 'x', 'y',
+                    'vel_x', 'vel_y', 'facing', 'in_hitstun', 'is_invulnerable', 'jumps_left', 'edge_distance']
+
+
+def _firefoxing(player: dict, opponent: dict, stage: melee.Stage) -> np.ndarray:
+    return np.isin(player['character'], [melee.Character.FOX.value, melee.Character.FALCO.value]) & \
+           ActionTables.firefoxing_table[_action(player)]
+
+
+def _firefoxing_of(player: melee.PlayerState, opponent: melee.PlayerState, stage: melee.Stage) -> int:
+    return 1 if player.character in [melee.Character.FOX, melee.Character.FALCO] and \
+                ActionTables.is_firefoxing(player.action) else 0
+
+
+def _side_features(side: str, player_side: bool) -> list:
+    features = []
+    for name in player_obs_names:
+        version, compute, scalar = player_feature_library[name]
+        if player_side:
+            features.append(Feature(f'{side}_{name}', version,
+                                    lambda p, o, stage, compute=compute: compute(p, stage),
+                                    lambda p, o, stage, scalar=scalar: scalar(p, stage)))
+        else:
+            features.append(Feature(f'{side}_{name}', version,
+                                    lambda p, o, stage, compute=compute: compute(o, stage),
+                                    lambda p, o, stage, scalar=scalar: scalar(o, stage)))
+    return features
+
+
+# The columns of generate_input, in order
+input_features = [
+    Feature('rel_x', 1, lambda p, o, stage: _promote(p['x'] - o['x']) / 20,
+            lambda p, o, stage: (p.position.x - o.position.x) / 20),
+    Feature('rel_y', 1, lambda p, o, stage: _promote(p['y'] - o['y']) / 10,
+            lambda p, o, stage: (p.position.y - o.position.y) / 10),
+    Feature('firefoxing', 1, _firefoxing, _firefoxing_of),
+    Feature('direction', 1, lambda p, o, stage: np.where(p['x'] < o['x'], 1, -1),
+            lambda p, o, stage: 1 if p.position.x < o.position.x else -1),
+    Feature('is_right', 1, lambda p, o, stage: np.where(p['x'] > o['x'], 1, -1),
+            lambda p, o, stage: 1 if p.position.x > o.position.x else -1),
+    Feature('is_above', 1, lambda p, o, stage: np.where(p['y'] > o['y'], 1, -1),
+            lambda p, o, stage: 1 if p.position.y > o.position.y else -1),
+    Feature('x_distance', 1, lambda p, o, stage: _promote(np.abs(p['x'] - o['x'])) - 3.5,
+            lambda p, o, stage: abs(p.position.x - o.position.x) - 3.5),
+] + _side_features('player', True) + _side_features('opponent', False)
+
+input_names = [feature.name for feature in input_features]
+# What Dataset manifests and model artifacts record to tell which definition of each column they hold
+feature_versions = {feature.name: feature.version for feature in input_features}
+_features_by_name = {feature.name: feature for feature in input_features}
+
+
+def get_player_obs_batch(player: dict, stage: melee.Stage) -> np.ndarray:
+    """get_player_obs for every frame of player_columns at once, returns (frames, len(player_obs_names))"""
+    obs = np.empty((len(player['x']), len(player_obs_names)), dtype=np.float64)
+    for i, name in enumerate(player_obs_names):
+        obs[:, i] = player_feature_library[name][1](player, stage)
+    return obs
+
+
+def generate_input_batch(player: dict, opponent: dict, stage: melee.Stage, names: list = None) -> np.ndarray:
+    """
+    generate_input for every frame of a replay at once. player and opponent come from player_columns.
+    Returns (frames, len(names)), by default every column of input_names.
+    """
+    features = input_features if names is None else [_features_by_name[name] for name in names]
+    obs = np.empty((len(player['x']), len(features)), dtype=np.float64)
+    for i, feature in enumerate(features):
+        obs[:, i] = feature.compute(player, opponent, stage)
+    return obs
 
 
 def generate_output(player: melee.PlayerState):
@@ -219,89 +407,140 @@ def generate_output(player: melee.PlayerState):
     return action_counter
 
 
-def decode_from_model(action: np.ndarray, player: melee.PlayerState = None, stage: melee.Stage = None):
-    action = action[0]
-    edge = 100
-    if stage is not None:
-        edge = melee.EDGE_POSITION.get(stage)
-    # if player is not None and player.position.y > 0 and abs(player.position.x) < 100:
-    if player is not None and player.position.y > 0:
-        reduce = [7,1,8,10, 9]
-        for i in reduce:
-            action[i] /= 5
-        if player.character in [melee.Character.FOX, melee.Character.FALCO, melee.Character.MARTH]:
-            action[14]/=100
-    if player.character in [melee.Character.FOX, melee.Character.FALCO]:
+def _pressed(buttons: np.ndarray, *pressed: melee.Button) -> np.ndarray:
+    mask = sum(1 << button_bits.index(b) for b in pressed)
+    return (buttons & mask) != 0
+
+
+def generate_output_batch(player: dict) -> np.ndarray:
+    """generate_output for every frame of player_columns at once, -1 where there is no action"""
+    buttons = player['buttons']
+    b = melee.Button
+    b_used = _pressed(buttons, b.BUTTON_B)
+    a_used = _pressed(buttons, b.BUTTON_A) & ~b_used
+    main_x, main_y = player['main_x'], player['main_y']
+    c_x, c_y = player['c_x'], player['c_y']
+
+    # Move stick, offset into the move, b or a block of output_names
+    offset = np.where(b_used, 11, np.where(a_used, 16, 7))
+    stick = np.select([main_x < low_analog, main_x > high_analog, main_y < low_analog, main_y > high_analog],
+                      [0, 1, 2, 3], 4)
+    lasers = b_used & np.isin(player['character'], [melee.Character.FOX.value, melee.Character.FALCO.value])
+    move = np.where((stick == 4) & (lasers | ~(b_used | a_used)), -1, offset + stick)
+
+    return np.select([_pressed(buttons, b.BUTTON_X, b.BUTTON_Y), _pressed(buttons, b.BUTTON_L, b.BUTTON_R),
+                      _pressed(buttons, b.BUTTON_Z),
+                      c_x < low_analog, c_x > high_analog, c_y < low_analog, c_y > high_analog],
+                     [0, 1, 2, 3, 4, 5, 6], move)
+
+
+def controller_states_different_batch(new: dict, old: dict) -> np.ndarray:
+    """controller_states_different row by row for two equally long sets of player_columns"""
+    different = (new['buttons'] & ~old['buttons']) != 0
+    for axis in ['c_x', 'c_y', 'main_x', 'main_y']:
+        different |= (new[axis] < low_analog) & (old[axis] >= low_analog)
+        different |= (new[axis] > high_analog) & (old[axis] <= high_analog)
+    return different
+
+
+# decode_from_model's weighting of the model's outputs, as divisors over output_names. They are applied in two
+# steps, exactly like the in place divisions they replace, since shield can be divided in both.
+# First step, indexed [Character.value, above ground level (y > 0), inside the edge]
+_fox_falco = [melee.Character.FOX.value, melee.Character.FALCO.value]
+_situation_divisors = np.ones((ActionTables.character_slots, 2, 2, len(output_names)))
+for _character in range(ActionTables.character_slots):
+    for _inside in [0, 1]:
+        _divisors = _situation_divisors[_character, 1, _inside]
+        # In the air, discourage shielding and wandering off with the move stick
+        _divisors[[7, 1, 8, 10, 9]] = 5
+        if _character in _fox_falco + [melee.Character.MARTH.value]:
+            _divisors[14] = 100
+    if _character in _fox_falco:
         # model can't cancel moves
-        if abs(player.position.x) < edge:
-            action[11]/=100
-            action[12]/=100
-
-    action[0]/=4
-    if not player.on_ground:
-        action[1] /= 100
-    # action[2] /= 100
-
-    a = np.argmax(action)
-    # [[BUTTON_X, BUTTON_B, BUTTON_L, BUTTON_A, BUTTON_Z], move_x, move_y, c_x, c_y]
-    if a == 0:  # jump
-        return a, [[1, 0, 0, 0, 0], 0, 0, 0, 0]
-    elif a == 1:  # shield
-        return a, [[0, 0, 1, 0, 0], 0, 0, 0, 0]
-    elif a == 2:  # grab
-        return a, [[0, 0, 0, 0, 1], 0, 0, 0, 0]
-
-    # c_stick
-    elif a == 3:
-        return a, [[0, 0, 0, 0, 0], 0, 0, -1, 0]
-    elif a == 4:
-        return a, [[0, 0, 0, 0, 0], 0, 0, 1, 0]
-    elif a == 5:
-        return a, [[0, 0, 0, 0, 0], 0, 0, 0, -1]
-    elif a == 6:
-        return a, [[0, 0, 0, 0, 0], 0, 0, 0, 1]
-
-
+        _situation_divisors[_character, :, 1, [11, 12]] = 100
+# Second step, indexed [on_ground]
+_ground_divisors = np.ones((2, len(output_names)))
+_ground_divisors[:, 0] = 4
+_ground_divisors[0, 1] = 100
+
+# The controller input of every action id as [[BUTTON_X, BUTTON_B, BUTTON_L, BUTTON_A, BUTTON_Z], move_x, move_y,
+# c_x, c_y]. decode_from_model hands these out without copying, so they must not be modified.
+action_commands = [
+    # jump, shield, grab
+    [[1, 0, 0, 0, 0], 0, 0, 0, 0], [[0, 0, 1, 0, 0], 0, 0, 0, 0], [[0, 0, 0, 0, 1], 0, 0, 0, 0],
+    # c stick
+    [[0, 0, 0, 0, 0], 0, 0, -1, 0], [[0, 0, 0, 0, 0], 0, 0, 1, 0],
+    [[0, 0, 0, 0, 0], 0, 0, 0, -1], [[0, 0, 0, 0, 0], 0, 0, 0, 1],
     # move stick
-    elif a == 7:
-        return a, [[0, 0, 0, 0, 0], -1, 0, 0, 0]
-    elif a == 8:
-        return a, [[0, 0, 0, 0, 0], 1, 0, 0, 0]
-    elif a == 9:
-        return a, [[0, 0, 0, 0, 0], 0, -1, 0, 0]
-    elif a == 10:
-        return a, [[0, 0, 0, 0, 0], 0, 1, 0, 0]
-
+    [[0, 0, 0, 0, 0], -1, 0, 0, 0], [[0, 0, 0, 0, 0], 1, 0, 0, 0],
+    [[0, 0, 0, 0, 0], 0, -1, 0, 0], [[0, 0, 0, 0, 0], 0, 1, 0, 0],
     # b moves
-    elif a == 11:
-        return a, [[0, 1, 0, 0, 0], -1, 0, 0, 0]
-    elif a == 12:
-        return a, [[0, 1, 0, 0, 0], 1, 0, 0, 0]
-    elif a == 13:
-        return a, [[0, 1, 0, 0, 0], 0, -1, 0, 0]
-    elif a == 14:
-        # b reverse not possible in the action space
-        if player is not None and player.character == melee.enums.Character.MARTH:
-            vel_y = player.speed_y_self + player.speed_y_attack
-
-            if player.jumps_left == 0 and player.position.y < -20 and vel_y < 0:
-                x = np.sign(player.position.x)
-                return a, [[0, 1, 0, 0, 0], -0.6 * x, 0.85, 0, 0]
-        return a, [[0, 1, 0, 0, 0], 0, 1, 0, 0]
-    elif a == 15:
-        return a, [[0, 1, 0, 0, 0], 0, 0, 0, 0]
-
+    [[0, 1, 0, 0, 0], -1, 0, 0, 0], [[0, 1, 0, 0, 0], 1, 0, 0, 0],
+    [[0, 1, 0, 0, 0], 0, -1, 0, 0], [[0, 1, 0, 0, 0], 0, 1, 0, 0], [[0, 1, 0, 0, 0], 0, 0, 0, 0],
     # a moves
-    elif a == 16:
-        return a, [[0, 0, 0, 1, 0], -1, 0, 0, 0]
-    elif a == 17:
-        return a, [[0, 0, 0, 1, 0], 1, 0, 0, 0]
-    elif a == 18:
-        return a, [[0, 0, 0, 1, 0], 0, -1, 0, 0]
-    elif a == 19:
-        return a, [[0, 0, 0, 1, 0], 0, 1, 0, 0]
-    elif a == 20:
-        return a, [[0, 0, 0, 1, 0], 0, 0, 0, 0]
-
-    print('NO ACTION FOUND !!!!')
-    return [[0, 0, 0, 0, 0], 0, 0, 0, 0]
+    [[0, 0, 0, 1, 0], -1, 0, 0, 0], [[0, 0, 0, 1, 0], 1, 0, 0, 0],
+    [[0, 0, 0, 1, 0], 0, -1, 0, 0], [[0, 0, 0, 1, 0], 0, 1, 0, 0], [[0, 0, 0, 1, 0], 0, 0, 0, 0],
+]
+action_buttons = np.array([buttons for buttons, *_ in action_commands])
+action_sticks = np.array([sticks for _, *sticks in action_commands], dtype=np.float64)
+
+# Per thread scratch space for decode_from_model, so a call allocates nothing and bots on other threads
+# don't share it
+_scratch = threading.local()
+
+
+def _scores(dtype) -> np.ndarray:
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    if dtype not in buffers:
+        buffers[dtype] = np.empty(len(output_names), dtype=dtype)
+    return buffers[dtype]
+
+
+def _edge_or_default(stage: melee.Stage):
+    return 100 if stage is None else melee.EDGE_POSITION.get(stage)
+
+
+def decode_from_model(action: np.ndarray, player: melee.PlayerState, stage: melee.Stage = None):
+    """
+    Picks the action id from one model prediction (shaped (1, len(output_names))) after weighting it for the
+    player's situation. Returns (action id, controller input as in action_commands). The prediction is left
+    untouched.
+    """
+    scores = _scores(action.dtype)
+    high = int(player.position.y > 0)
+    inside = int(abs(player.position.x) < _edge_or_default(stage))
+    np.divide(action[0], _situation_divisors[player.character.value, high, inside], out=scores)
+    np.divide(scores, _ground_divisors[int(player.on_ground)], out=scores)
+    a = int(np.argmax(scores))
+
+    if a == 14 and player.character == melee.enums.Character.MARTH:
+        # b reverse not possible in the action space
+        vel_y = player.speed_y_self + player.speed_y_attack
+        if player.jumps_left == 0 and player.position.y < -20 and vel_y < 0:
+            x = np.sign(player.position.x)
+            return a, [[0, 1, 0, 0, 0], -0.6 * x, 0.85, 0, 0]
+    return a, action_commands[a]
+
+
+def decode_from_model_batch(actions: np.ndarray, player: dict, stage: melee.Stage = None):
+    """
+    decode_from_model for a batch of predictions, player being the player_columns of the same frames.
+    Returns (action ids, buttons shaped (n, 5), sticks shaped (n, 4) as move_x, move_y, c_x, c_y).
+    """
+    scores = np.empty_like(actions)
+    high = (player['y'] > 0).astype(np.intp)
+    inside = (np.abs(player['x']) < _edge_or_default(stage)).astype(np.intp)
+    np.divide(actions, _situation_divisors[player['character'], high, inside], out=scores)
+    np.divide(scores, _ground_divisors[player['on_ground'].astype(np.intp)], out=scores)
+    a = np.argmax(scores, axis=1)
+
+    buttons = action_buttons[a]
+    sticks = action_sticks[a]
+    vel_y = player['speed_y_self'] + player['speed_y_attack']
+    recover = (a == 14) & (player['character'] == melee.Character.MARTH.value) & (player['jumps_left'] == 0) & \
+              (player['y'] < -20) & (vel_y < 0)
+    sticks[recover, 0] = -0.6 * np.sign(player['x'][recover])
+    sticks[recover, 1] = 0.85
+    return a, buttons, sticks
@@ -0,0 +1,659 @@
+import json
+import os
+import pickle
+import shutil
+
+import melee
+import numpy as np
+
+from DataHandler import input_names, output_names, feature_versions
+
+# A dataset is a folder of fixed dtype .npy shards plus a manifest.json describing them:
+#
+#     Data/FOX_FALCO_on_FINAL_DESTINATION/
+#         manifest.json
+#         X_00000.npy  Y_00000.npy
+#         X_00001.npy  Y_00001.npy
+#         ...
+#
+# Y shards hold the action id of every row (uint8 indices into DataHandler.output_names), read back as one-hot
+# rows. Format 1 datasets stored the one-hot rows themselves and are still read.
+#
+# The manifest records the version of every X column (DataHandler.feature_versions) and, per replay, the
+# content hash and player slot the rows came from. With the optional F_*.npy shards holding each row's frame
+# in the frame cache, columns can be recomputed without touching the rest (generate_data.update_features).
+#
+# Shards are opened with np.load(mmap_mode='r'), so only the rows that are actually read are paged in.
+#
+# A compacted dataset (compact_dataset) also has W_*.npy shards: each row stands for that many identical
+# samples, and training passes it as sample_weight.
+#
+# stats.json holds the count, mean, variance, min and max of every X column (FeatureStats), gathered while
+# the dataset was written.
+
+format_version = 2
+manifest_name = 'manifest.json'
+stats_name = 'stats.json'
+default_shard_rows = 1 << 18
+# Observations closer than this in every column count as the same sample when compacting
+default_compact_step = 1e-3
+
+
+def dataset_path(player_character: melee.Character, opponent_character: melee.Character, stage: melee.Stage,
+                 folder: str = 'Data'):
+    return f'{folder}/{player_character.name}_{opponent_character.name}_on_{stage.name}'
+
+
+def legacy_path(player_character: melee.Character, opponent_character: melee.Character, stage: melee.Stage,
+                folder: str = 'Data'):
+    return f'{folder}/{player_character.name}_{opponent_character.name}_on_{stage.name}_data.pkl'
+
+
+def parse_matchup(name: str):
+    """Inverse of dataset_path's folder name: 'FOX_CPTFALCON_on_FINAL_DESTINATION' -> (FOX, CPTFALCON, FD)"""
+    characters, stage = name.rsplit('_on_', 1)
+    parts = characters.split('_')
+    # Character names can contain underscores, so try every split point
+    for i in range(1, len(parts)):
+        c1, c2 = '_'.join(parts[:i]), '_'.join(parts[i:])
+        if c1 in melee.Character.__members__ and c2 in melee.Character.__members__:
+            return melee.Character[c1], melee.Character[c2], melee.Stage[stage]
+    raise ValueError(f'{name} is not a matchup')
+
+
+def find_datasets(folder: str = 'Data') -> list:
+    """Every (player_character, opponent_character, stage) with a dataset in folder, new format or old pickle"""
+    found = set()
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if name.endswith('.tmp'):
+                # Left behind by a DatasetWriter or copy_dataset that was interrupted
+                continue
+            if os.path.exists(os.path.join(folder, name, manifest_name)):
+                found.add(parse_matchup(name))
+            elif name.endswith('_data.pkl'):
+                found.add(parse_matchup(name[:-len('_data.pkl')]))
+    return sorted(found, key=lambda m: (m[0].name, m[1].name, m[2].name))
+
+
+class FeatureStats:
+    """
+    Running count, mean, variance, min and max of every column, updated a block of rows at a time in one pass.
+    Blocks are combined with Chan et al.'s pairwise form of Welford's update, which is also how two FeatureStats
+    gathered separately (e.g. by different workers) are merged. Rows can be weighted by how many samples they
+    stand for.
+    """
+
+    def __init__(self, schema: list):
+        self.schema = list(schema)
+        self.count = 0.0
+        self.mean = np.zeros(len(schema))
+        self.m2 = np.zeros(len(schema))
+        self.min = np.full(len(schema), np.inf)
+        self.max = np.full(len(schema), -np.inf)
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / self.count if self.count else np.zeros(len(self.schema))
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def update(self, X: np.ndarray, weights: np.ndarray = None):
+        if len(X) == 0:
+            return
+        X = np.asarray(X, dtype=np.float64)
+        block = FeatureStats(self.schema)
+        if weights is None:
+            block.count = float(len(X))
+            block.mean = X.mean(axis=0)
+            block.m2 = ((X - block.mean) ** 2).sum(axis=0)
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            block.count = float(weights.sum())
+            if block.count == 0:
+                return
+            block.mean = weights @ X / block.count
+            block.m2 = weights @ (X - block.mean) ** 2
+        block.min = X.min(axis=0)
+        block.max = X.max(axis=0)
+        self.merge(block)
+
+    def merge(self, other: 'FeatureStats'):
+        if other.schema != self.schema:
+            raise ValueError('Cannot merge stats of different columns')
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def affine(self) -> tuple:
+        """
+        (scale, shift) standardizing every column as X * scale + shift. Constant columns are only centered.
+        """
+        std = self.std
+        scale = 1 / np.where(std > 0, std, 1)
+        return scale, -self.mean * scale
+
+    def to_dict(self) -> dict:
+        return {'schema': self.schema, 'count': self.count, 'mean': self.mean.tolist(),
+                'variance': self.variance.tolist(), 'min': self.min.tolist(), 'max': self.max.tolist()}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'FeatureStats':
+        stats = FeatureStats(data['schema'])
+        stats.count = data['count']
+        stats.mean = np.array(data['mean'], dtype=np.float64)
+        stats.m2 = np.array(data['variance'], dtype=np.float64) * stats.count
+        stats.min = np.array(data['min'], dtype=np.float64)
+        stats.max = np.array(data['max'], dtype=np.float64)
+        return stats
+
+
+class DatasetWriter:
+    """
+    Builds the dataset at path a chunk at a time. Appended rows are copied into buffers preallocated for
+    chunk_rows rows, and every full buffer is written out as a shard, so memory stays the same however many rows
+    come in. Labels are action ids, indices into output_names. With frames or weights every append must pass them.
+    Used as a context manager, the dataset replaces any dataset already at path when the block ends, and
+    nothing is left behind if it raises.
+    """
+
+    def __init__(self, path: str, chunk_rows: int = default_shard_rows, x_dtype=np.float32, schema: list = None,
+                 versions: dict = None, frames: bool = False, weights: bool = False, validation_start: int = None):
+        if schema is None:
+            schema = input_names
+        if versions is None:
+            versions = {name: feature_versions[name] for name in schema if name in feature_versions}
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.schema = schema
+        self.versions = versions
+        self.chunk_rows = int(chunk_rows)
+        self.x = np.empty((self.chunk_rows, len(schema)), dtype=x_dtype)
+        self.actions = np.empty(self.chunk_rows, dtype=np.uint8)
+        self.frames = np.empty(self.chunk_rows, dtype=np.int32) if frames else None
+        self.weights = np.empty(self.chunk_rows, dtype=np.float32) if weights else None
+        self.filled = 0
+        self.rows = 0
+        self.shards = []
+        self.replays = []
+        self.stats = FeatureStats(schema)
+        self.validation_start = validation_start
+
+        # Build next to the destination and swap it in at the end so readers never see half a dataset
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """Throws away what was written so far, leaving any dataset at path as it was"""
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def append(self, X: np.ndarray, actions: np.ndarray, frames: np.ndarray = None, weights: np.ndarray = None):
+        for name, column, buffer in [('actions', actions, self.actions), ('frames', frames, self.frames),
+                                     ('weights', weights, self.weights)]:
+            if (column is None) != (buffer is None):
+                raise ValueError(f'{self.path} is written {"with" if buffer is not None else "without"} {name}')
+            if column is not None and len(column) != len(X):
+                raise ValueError(f'X has {len(X)} rows but {name} has {len(column)}')
+
+        start = 0
+        while start < len(X):
+            rows = min(len(X) - start, self.chunk_rows - self.filled)
+            end = self.filled + rows
+            self.x[self.filled:end] = X[start:start + rows]
+            self.actions[self.filled:end] = actions[start:start + rows]
+            if frames is not None:
+                self.frames[self.filled:end] = frames[start:start + rows]
+            if weights is not None:
+                self.weights[self.filled:end] = weights[start:start + rows]
+            self.filled = end
+            start += rows
+            if self.filled == self.chunk_rows:
+                self._flush()
+
+    def add_replay(self, replay_path: str, rows: int, info: dict = None):
+        """Records that the next rows rows came from replay_path, info is stored with it (e.g. hash, player slot)"""
+        start = sum(replay['stop'] - replay['start'] for replay in self.replays)
+        self.replays.append({'path': replay_path, 'start': start, 'stop': start + rows, **(info or {})})
+
+    def _flush(self):
+        self.stats.update(self.x[:self.filled], None if self.weights is None else self.weights[:self.filled])
+        i = len(self.shards)
+        shard = {'x': f'X_{i:05d}.npy', 'y': f'Y_{i:05d}.npy', 'rows': self.filled}
+        np.save(os.path.join(self.tmp_path, shard['x']), self.x[:self.filled])
+        np.save(os.path.join(self.tmp_path, shard['y']), self.actions[:self.filled])
+        if self.frames is not None:
+            shard['frames'] = f'F_{i:05d}.npy'
+            np.save(os.path.join(self.tmp_path, shard['frames']), self.frames[:self.filled])
+        if self.weights is not None:
+            shard['weights'] = f'W_{i:05d}.npy'
+            np.save(os.path.join(self.tmp_path, shard['weights']), self.weights[:self.filled])
+        self.shards.append(shard)
+        self.rows += self.filled
+        self.filled = 0
+
+    def close(self):
+        if self.filled:
+            self._flush()
+        manifest = {
+            'format_version': format_version,
+            'rows': self.rows,
+            'x': {'dtype': self.x.dtype.name, 'columns': len(self.schema), 'schema': self.schema,
+                  'versions': self.versions},
+            'y': {'dtype': self.actions.dtype.name, 'columns': len(output_names), 'schema': output_names,
+                  'encoding': 'action_ids'},
+            'shards': self.shards,
+            'replays': self.replays,
+        }
+        if self.validation_start is not None:
+            manifest['validation_start'] = self.validation_start
+        with open(os.path.join(self.tmp_path, manifest_name), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        with open(os.path.join(self.tmp_path, stats_name), 'w') as file:
+            json.dump(self.stats.to_dict(), file, indent=2)
+
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+
+def action_ids(Y: np.ndarray) -> np.ndarray:
+    """Action ids of labels that are either ids already or one-hot rows over output_names"""
+    Y = np.asarray(Y)
+    return (Y if Y.ndim == 1 else np.argmax(Y, axis=1)).astype(np.uint8)
+
+
+def write_dataset(path: str, X: np.ndarray, Y: np.ndarray, replays: list = None, frames: np.ndarray = None,
+                  weights: np.ndarray = None, shard_rows: int = default_shard_rows, x_dtype=np.float32,
+                  schema: list = None, versions: dict = None, validation_start: int = None):
+    """
+    Writes X, Y as a sharded dataset at path, replacing any dataset already there. Y holds action ids or one-hot
+    rows, which are stored as action ids.
+    replays is a list of (replay_path, rows) or (replay_path, rows, info) giving how many consecutive rows came
+    from each replay, info is stored with the replay (e.g. its hash and player slot). frames is the frame
+    cache index of every row, weights the number of samples every row stands for. schema and versions
+    describe the X columns and default to DataHandler's. validation_start is the first held out row, see
+    ShardedDataset.validation_start.
+    """
+    X = np.asarray(X)
+    if len(X) != len(Y):
+        raise ValueError(f'X has {len(X)} rows but Y has {len(Y)}')
+    if schema is None:
+        schema = input_names
+    with DatasetWriter(path, shard_rows, x_dtype=x_dtype, schema=schema, versions=versions,
+                       frames=frames is not None, weights=weights is not None,
+                       validation_start=validation_start) as writer:
+        writer.append(X.reshape(len(X), len(schema)), action_ids(Y), frames, weights)
+        for replay_path, rows, *info in replays or []:
+            writer.add_replay(replay_path, rows, info[0] if info else None)
+
+
+def copy_dataset(path: str, destination: str):
+    """Copies the dataset at path to destination, replacing any dataset already there"""
+    tmp_path = destination + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    shutil.copytree(path, tmp_path)
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.replace(tmp_path, destination)
+
+
+class ShardedArray:
+    """
+    Read only view of one column group (X or Y) spread over several memory mapped shards. With columns=None
+    the shards are one dimensional (e.g. the weights).
+    """
+
+    def __init__(self, shards: list, columns: int, dtype):
+        self.shards = shards
+        self.dtype = np.dtype(dtype)
+        self.offsets = np.cumsum([0] + [len(s) for s in shards])
+        self.shape = (int(self.offsets[-1]),) if columns is None else (int(self.offsets[-1]), columns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            shard = np.searchsorted(self.offsets, item, side='right') - 1
+            return self.shards[shard][item - self.offsets[shard]]
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1:
+                return self._range(start, stop)
+            item = np.arange(start, stop, step)
+        return self.take(np.asarray(item))
+
+    def __array__(self, dtype=None, copy=None):
+        out = self._range(0, len(self))
+        return out if dtype is None else out.astype(dtype)
+
+    def _range(self, start: int, stop: int):
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        for shard, offset in zip(self.shards, self.offsets):
+            lo = max(start, offset)
+            hi = min(stop, offset + len(shard))
+            if lo < hi:
+                out[lo - start:hi - start] = shard[lo - offset:hi - offset]
+        return out
+
+    def take(self, indices: np.ndarray):
+        """Gathers arbitrary rows, reading each shard once"""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        shard_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        for s in np.unique(shard_of):
+            mask = shard_of == s
+            out[mask] = self.shards[s][indices[mask] - self.offsets[s]]
+        return out
+
+
+class OneHotArray:
+    """Read only view of a ShardedArray of action ids as one-hot rows, only the rows read are expanded"""
+
+    def __init__(self, ids: ShardedArray, columns: int, dtype=np.float32):
+        self.ids = ids
+        self.eye = np.eye(columns, dtype=dtype)
+        self.dtype = self.eye.dtype
+        self.shape = (len(ids), columns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return self.eye[self.ids[item]]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def take(self, indices: np.ndarray):
+        return self.eye[self.ids.take(indices)]
+
+
+class ShardedDataset:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, manifest_name), 'r') as file:
+            self.manifest = json.load(file)
+        if self.manifest['format_version'] > format_version:
+            raise ValueError(f'{path} was written by a newer dataset format ({self.manifest["format_version"]})')
+
+        x_shards = [np.load(os.path.join(path, s['x']), mmap_mode='r') for s in self.manifest['shards']]
+        y_shards = [np.load(os.path.join(path, s['y']), mmap_mode='r') for s in self.manifest['shards']]
+        self.X = ShardedArray(x_shards, self.manifest['x']['columns'], self.manifest['x']['dtype'])
+        if self.encoded:
+            self.labels = ShardedArray(y_shards, None, self.manifest['y']['dtype'])
+            self.Y = OneHotArray(self.labels, self.manifest['y']['columns'])
+        else:
+            self.labels = None
+            self.Y = ShardedArray(y_shards, self.manifest['y']['columns'], self.manifest['y']['dtype'])
+        self.W = None
+        if self.weighted:
+            w_shards = [np.load(os.path.join(path, s['weights']), mmap_mode='r') for s in self.manifest['shards']]
+            self.W = ShardedArray(w_shards, None, np.float32)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def feature_schema(self) -> list:
+        return self.manifest['x']['schema']
+
+    @property
+    def feature_versions(self) -> dict:
+        """Version of every X column, empty for datasets written before columns were versioned"""
+        return self.manifest['x'].get('versions', {})
+
+    @property
+    def replays(self) -> list:
+        return self.manifest['replays']
+
+    def validation_start(self, validation_split: float) -> int:
+        """
+        First row of the held out tail: the one recorded when the dataset was compacted, since compaction
+        shrinks the training and validation rows by different amounts, otherwise the last validation_split
+        """
+        if 'validation_start' in self.manifest:
+            return self.manifest['validation_start']
+        return len(self) - int(len(self) * validation_split)
+
+    @property
+    def encoded(self) -> bool:
+        """Whether Y is stored as action ids, format 1 datasets store one-hot rows"""
+        return self.manifest['y'].get('encoding') == 'action_ids'
+
+    def action_ids(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """The action id of every row between start and stop"""
+        stop = len(self) if stop is None else stop
+        return self.labels[start:stop] if self.encoded else action_ids(self.Y[start:stop])
+
+    @property
+    def weighted(self) -> bool:
+        return len(self.manifest['shards']) > 0 and all('weights' in s for s in self.manifest['shards'])
+
+    def weights(self) -> np.ndarray:
+        """How many samples every row stands for, all ones unless the dataset was compacted"""
+        return self.W[:] if self.weighted else np.ones(len(self), dtype=np.float32)
+
+    def total_weight(self) -> float:
+        return float(self.weights().sum(dtype=np.float64))
+
+    def feature_stats(self) -> FeatureStats:
+        """
+        Statistics of the X columns, weighted by the row weights. Datasets written before they were gathered
+        get them computed in one pass over their shards and saved.
+        """
+        stats_path = os.path.join(self.path, stats_name)
+        if os.path.exists(stats_path):
+            with open(stats_path, 'r') as file:
+                stats = FeatureStats.from_dict(json.load(file))
+            if stats.schema == self.feature_schema:
+                return stats
+        stats = FeatureStats(self.feature_schema)
+        for block in self.blocks(block_rows=default_shard_rows, weights=self.weighted):
+            stats.update(block[0], block[2] if self.weighted else None)
+        with open(stats_path, 'w') as file:
+            json.dump(stats.to_dict(), file, indent=2)
+        return stats
+
+    def has_frames(self) -> bool:
+        return all('frames' in s for s in self.manifest['shards'])
+
+    def frames(self) -> np.ndarray:
+        """The frame cache index of every row"""
+        if not self.has_frames():
+            raise ValueError(f'{self.path} was written without frame indices')
+        return np.concatenate([np.load(os.path.join(self.path, s['frames'])) for s in self.manifest['shards']]
+                              + [np.empty(0, dtype=np.int32)])
+
+    def blocks(self, start: int = 0, stop: int = None, block_rows: int = 4096, shuffle: bool = False,
+               seed: int = None, weights: bool = False):
+        """
+        Yields (X, Y) blocks of up to block_rows consecutive rows between start and stop. With shuffle the blocks
+        come in random order, so a shuffle buffer downstream only has to mix rows within a few blocks.
+        With weights the blocks are (X, Y, W), W being all ones for a dataset that was not compacted.
+        """
+        stop = len(self) if stop is None else stop
+        starts = np.arange(start, stop, block_rows)
+        if shuffle:
+            np.random.default_rng(seed).shuffle(starts)
+        for s in starts:
+            e = min(s + block_rows, stop)
+            if not weights:
+                yield self.X[s:e], self.Y[s:e]
+            elif self.weighted:
+                yield self.X[s:e], self.Y[s:e], self.W[s:e]
+            else:
+                yield self.X[s:e], self.Y[s:e], np.ones(e - s, dtype=np.float32)
+
+    def shards(self):
+        """Yields (X, Y) one shard at a time, X memory mapped"""
+        if not self.encoded:
+            yield from zip(self.X.shards, self.Y.shards)
+            return
+        for x, ids in zip(self.X.shards, self.labels.shards):
+            yield x, self.Y.eye[ids]
+
+
+def open_dataset(path: str) -> ShardedDataset:
+    return ShardedDataset(path)
+
+
+def stale_features(dataset: ShardedDataset) -> list:
+    """Columns of input_names the dataset lacks or holds in a different version than DataHandler computes"""
+    versions = dataset.feature_versions
+    if not versions:
+        # Unversioned datasets only know the column names, trust the columns whose name matches
+        versions = {name: feature_versions.get(name) for name in dataset.feature_schema}
+    return [name for name in input_names if versions.get(name) != feature_versions[name]]
+
+
+def row_hashes(rows: np.ndarray, seed: int = 0xcbf29ce484222325) -> np.ndarray:
+    """A 64 bit hash of every row of an integer array, computed a column at a time. Other seeds give other hashes."""
+    hashes = np.full(len(rows), seed, dtype=np.uint64)
+    for column in rows.T:
+        hashes ^= column.astype(np.int64).view(np.uint64)
+        hashes *= np.uint64(0x100000001b3)
+    # splitmix64's finalizer, so rows that differ in one column differ in every bit of the hash
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def _take_action_ids(dataset: 'ShardedDataset', rows: np.ndarray) -> np.ndarray:
+    return dataset.labels.take(rows) if dataset.encoded else action_ids(dataset.Y.take(rows))
+
+
+def _quantized_rows(dataset: 'ShardedDataset', rows: np.ndarray, step: float) -> np.ndarray:
+    """The observations of rows rounded to multiples of step, with the action id as an extra column"""
+    X = dataset.X.take(rows)
+    actions = _take_action_ids(dataset, rows)
+    return np.concatenate([np.round(X / step).astype(np.int64), actions[:, None].astype(np.int64)], axis=1)
+
+
+def _sample_keys(dataset: 'ShardedDataset', step: float, seeds: list) -> np.ndarray:
+    """One row_hashes column per seed for every row of dataset, hashed a shard at a time"""
+    keys = np.empty((len(dataset), len(seeds)), dtype=np.uint64)
+    for start, stop in zip(dataset.X.offsets[:-1], dataset.X.offsets[1:]):
+        quantized = _quantized_rows(dataset, np.arange(start, stop), step)
+        for i, seed in enumerate(seeds):
+            keys[start:stop, i] = row_hashes(quantized, seed)
+    return keys
+
+
+def _groups(keys: np.ndarray, start: int, stop: int):
+    """(first row, group of every row) of the rows start:stop with equal keys, rows counted from 0"""
+    _, first, inverse = np.unique(keys[start:stop], axis=0, return_index=True, return_inverse=True)
+    return first + start, inverse.reshape(-1)
+
+
+def _groups_match(dataset: 'ShardedDataset', step: float, representative: np.ndarray) -> bool:
+    """Whether every row quantizes to the same row as representative[row], checked a shard at a time"""
+    for start, stop in zip(dataset.X.offsets[:-1], dataset.X.offsets[1:]):
+        rows = np.arange(start, stop)
+        if not np.array_equal(_quantized_rows(dataset, rows, step),
+                              _quantized_rows(dataset, representative[rows], step)):
+            return False
+    return True
+
+
+def compact_dataset(path: str, step: float = default_compact_step, validation_split: float = 0.1) -> tuple:
+    """
+    Collapses the samples of the dataset at path whose observations round to the same multiple of step and
+    whose labels match into one row, weighted by how many samples it stands for. The first sample of every group
+    is kept, in dataset order, so replay provenance stays meaningful. The held out tail (the split recorded by an
+    earlier compaction, else the last validation_split of the rows) is compacted on its own, so no validation
+    sample is folded into a training one, and where it starts is recorded in the manifest.
+    Rows are hashed and written a shard at a time, only a hash, a weight and a frame per row are held in memory.
+    Returns (rows before, rows after).
+    """
+    dataset = open_dataset(path)
+    weights = dataset.weights()
+    validation_start = dataset.validation_start(validation_split)
+
+    seeds = [0xcbf29ce484222325]
+    while True:
+        keys = _sample_keys(dataset, step, seeds)
+        train_first, train_inverse = _groups(keys, 0, validation_start)
+        validation_first, validation_inverse = _groups(keys, validation_start, len(dataset))
+        first = np.concatenate([train_first, validation_first])
+        inverse = np.concatenate([train_inverse, validation_inverse + len(train_first)])
+        if _groups_match(dataset, step, first[inverse]):
+            break
+        if len(seeds) == 2:
+            raise ValueError(f'{path} has different rows that share both 64 bit hashes')
+        # Two different rows share a hash, add a second one
+        seeds.append(0x9e3779b97f4a7c15)
+
+    counts = np.bincount(inverse, weights=weights, minlength=len(first))
+    order = np.argsort(first, kind='stable')
+    kept = first[order]
+    frames = dataset.frames() if dataset.has_frames() else None
+
+    writer = DatasetWriter(path, x_dtype=dataset.X.dtype, schema=dataset.feature_schema,
+                           versions=dataset.feature_versions, frames=frames is not None, weights=True,
+                           validation_start=int(np.searchsorted(kept, validation_start)))
+    try:
+        for start in range(0, len(kept), default_shard_rows):
+            rows = kept[start:start + default_shard_rows]
+            writer.append(dataset.X.take(rows), _take_action_ids(dataset, rows),
+                          None if frames is None else frames[rows], counts[order][start:start + default_shard_rows])
+        for replay in dataset.replays:
+            start, stop = np.searchsorted(kept, [replay['start'], replay['stop']])
+            info = {k: v for k, v in replay.items() if k not in ['path', 'start', 'stop']}
+            writer.add_replay(replay['path'], int(stop - start), info)
+    except BaseException:
+        writer.abort()
+        raise
+    rows = len(dataset)
+    # Let go of the memory mapped shards before the dataset is replaced
+    del dataset
+    writer.close()
+    return rows, len(kept)
+
+
+def convert_legacy(pickle_path: str, path: str):
+    """Rewrites an old pickled {'X', 'Y'} blob as a sharded dataset"""
+    with open(pickle_path, 'rb') as file:
+        data = pickle.load(file)
+    write_dataset(path, data['X'], data['Y'])
+
+
+def load_dataset(player_character: melee.Character, opponent_character: melee.Character, stage: melee.Stage,
+                 folder: str = 'Data') -> ShardedDataset:
+    """Opens the dataset for a matchup, converting it from the old pickle format the first time if needed"""
+    path = dataset_path(player_character, opponent_character, stage, folder)
+    if not os.path.exists(os.path.join(path, manifest_name)):
+        old = legacy_path(player_character, opponent_character, stage, folder)
+        if not os.path.exists(old):
+            raise FileNotFoundError(f'No dataset at {path} or {old}')
+        print('Converting', old, 'to', path)
+        convert_legacy(old, path)
+    return open_dataset(path)
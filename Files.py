@@ -0,0 +1,19 @@
+import json
+import os
+
+
+def file_key(path: str):
+    """[size, mtime] of the file at path, which changes whenever the file does. None if there is no such file."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_json(path: str, data):
+    # Write to a temporary file and swap it in, so an interrupted run never leaves a truncated file behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
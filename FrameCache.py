@@ -0,0 +1,177 @@
+import hashlib
+import os
+
+import melee
+import numpy as np
+
+from DataHandler import ColumnRecorder, player_fields
+import Timing
+
+# Parsing a .slp with libmelee is by far the slowest part of indexing and data generation, so every replay is
+# parsed once and its raw per-frame player fields are kept in frame_cache/<content hash>.npz:
+#
+#     version             cache_version the file was written with
+#     ports               the two ports, in gamestate.players order
+#     stage               Stage.value
+#     first_press         per port, the first frame after frame 0 any button is pressed, -1 if never
+#     0_<field> 1_<field> one typed column per DataHandler.player_fields entry and port, over every frame
+#
+# Frame 0 is the first gamestate console.step() returns, the frames after it run until the replay ends or a
+# player goes missing. Replays are keyed by content, so a renamed or copied replay still hits the cache.
+
+cache_version = 2
+default_folder = 'frame_cache'
+
+
+def content_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RawFrames:
+    """The cached frames of one replay: ports, stage and a player_columns style dict per port"""
+
+    def __init__(self, ports: list, stage: melee.Stage, players: list, first_press: list, replay_hash: str = None):
+        self.ports = ports
+        self.stage = stage
+        self.players = players
+        self.first_press = first_press
+        self.replay_hash = replay_hash
+
+    def __len__(self):
+        return len(self.players[0]['x'])
+
+    def characters(self) -> list:
+        return [melee.Character(int(player['character'][0])) for player in self.players]
+
+    def slots(self, player_character: melee.Character, opponent_character: melee.Character):
+        """Like DataHandler.get_ports, but returns indices into players, (-1, -1) if the characters don't match"""
+        c1, c2 = self.characters()
+        if c1 == player_character and c2 == opponent_character:
+            return 0, 1
+        if c2 == player_character and c1 == opponent_character:
+            return 1, 0
+        print(c1, c2)
+        return -1, -1
+
+    def to_arrays(self) -> dict:
+        arrays = {'version': np.array(cache_version), 'ports': np.array(self.ports),
+                  'stage': np.array(self.stage.value), 'first_press': np.array(self.first_press)}
+        for i, player in enumerate(self.players):
+            for name, column in player.items():
+                arrays[f'{i}_{name}'] = column
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays) -> 'RawFrames':
+        players = [{name: arrays[f'{i}_{name}'] for name, _ in player_fields} for i in range(2)]
+        return RawFrames([int(p) for p in arrays['ports']], melee.Stage(int(arrays['stage'])), players,
+                         [int(f) for f in arrays['first_press']])
+
+
+def _pressed_any(player: melee.PlayerState) -> bool:
+    controller: melee.ControllerState = player.controller_state
+    return any(controller.button.get(b) for b in melee.enums.Button)
+
+
+def parse_replay(path: str) -> RawFrames:
+    """Steps through a replay with libmelee once and records both players, raises with the reason if unusable"""
+    console = melee.Console(is_dolphin=False,
+                            allow_old_version=True,
+                            path=path)
+    try:
+        console.connect()
+    except Exception as e:
+        console.stop()
+        raise RuntimeError(f'console failed to connect: {e!r}')
+    try:
+        gamestate: melee.GameState = console.step()
+
+        if gamestate is None:
+            raise RuntimeError('gamestate is none')
+
+        if gamestate.stage is None:
+            raise RuntimeError('stage is none')
+
+        ports = list(gamestate.players.keys())
+        if len(ports) != 2:
+            raise RuntimeError(f'not two ports {ports}')
+        stage = gamestate.stage
+
+        recorders = [ColumnRecorder(), ColumnRecorder()]
+        first_press = [-1, -1]
+        frame = 0
+        while True:
+            players = [gamestate.players.get(port) for port in ports]
+            if None in players:
+                break
+            with Timing.stage('record_frame'):
+                for i, player in enumerate(players):
+                    recorders[i].append(player)
+                    # Buttons held on frame 0 don't count, like organize_replays always looked from frame 1
+                    if first_press[i] == -1 and frame > 0 and _pressed_any(player):
+                        first_press[i] = frame
+            frame += 1
+
+            try:
+                with Timing.stage('console.step'):
+                    gamestate = console.step()
+            except Exception:
+                break
+            if gamestate is None or gamestate.stage is None:
+                break
+    finally:
+        console.stop()
+
+    return RawFrames(ports, stage, [recorder.columns() for recorder in recorders], first_press)
+
+
+def cache_path(replay_hash: str, folder: str = default_folder) -> str:
+    return os.path.join(folder, f'{replay_hash}.npz')
+
+
+def read_cached(path: str):
+    """The RawFrames cached at path, None if there is none or it was written for other fields or another version"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as cached:
+            if int(cached['version']) != cache_version:
+                return None
+            if any(f'{i}_{name}' not in cached.files for i in range(2) for name, _ in player_fields):
+                return None
+            return RawFrames.from_arrays({name: cached[name] for name in cached.files})
+    except (OSError, ValueError, KeyError) as e:
+        print('Ignoring unreadable frame cache', path, e)
+        return None
+
+
+def write_cached(path: str, frames: RawFrames):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Several workers can parse the same replay at once, each writes its own temporary file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **frames.to_arrays())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Could not cache frames', path, e)
+
+
+def load(path: str, folder: str = default_folder) -> RawFrames:
+    """RawFrames of the replay at path, from the cache in folder if it has them. An empty folder skips the cache."""
+    with Timing.stage('content_hash'):
+        replay_hash = content_hash(path)
+    with Timing.stage('read_frame_cache'):
+        frames = read_cached(cache_path(replay_hash, folder)) if folder else None
+    if frames is None:
+        with Timing.stage('parse_replay'):
+            frames = parse_replay(path)
+        if folder:
+            with Timing.stage('write_frame_cache'):
+                write_cached(cache_path(replay_hash, folder), frames)
+    frames.replay_hash = replay_hash
+    return frames
@@ -6,6 +6,8 @@ import melee
 
 import numpy as np
 
+import Timing
+
 class Args:
     compete: bool
 
@@ -21,6 +23,30 @@ class Args:
     model_path: str
     cpu_level: int
     wandb: bool
+    workers: int
+    replay_timeout: float
+    inference: str
+    latency_log: str
+    batch_size: int
+    epochs: int
+    validation_split: float
+    shuffle_buffer: int
+    lr: float
+    normalize: bool
+    train_workers: int
+    replay: str
+    frame_cache: str
+    chunk_rows: int
+    rebuild_features: bool
+    compact_step: float
+    self_play: bool
+    pipeline: bool
+    late_policy: str
+    pipeline_wait: float
+    precision: str
+    profile: bool
+    profiler: str
+    profile_output: str
 
 
 class Game:
@@ -28,6 +54,10 @@ class Game:
         self.args: Args = args
 
         self.first_match_started = False
+        # Bots share this to time their sections, dumped on ^C
+        self.timer = Timing.FrameTimer()
+        # Called on ^C before the timer is dumped, e.g. to stop the worker threads of pipelined bots
+        self.on_exit = []
         # This logger object is useful for retroactively debugging issues in your bot
         #   You can write things to it each frame, and it will create a CSV file describing the match
         self.log = None
@@ -39,6 +69,7 @@ class Game:
         #   The Console represents the virtual or hardware system Melee is playing on.
         #   Through this object, we can get "GameState" objects per-frame so that your
         #       bot can actually "see" what's happening in the game
+        print(args.dolphin_executable_path)
         self.console: melee.Console = melee.Console(path=args.dolphin_executable_path,
                                                     slippi_address=args.address,
                                                     logger=self.log, polling_mode=False, online_delay=0,
@@ -85,24 +116,32 @@ class Game:
 
     # This isn't necessary, but makes it so that Dolphin will get killed when you ^C
     def signal_handler(self, sig, frame):
+        for callback in self.on_exit:
+            callback()
         self.console.stop()
         if self.args.debug:
             self.log.writelog()
             print("")  # because the ^C will be on the terminal
             print("Log file created: " + self.log.filename)
+        if self.args.latency_log:
+            self.timer.dump(self.args.latency_log)
         print("Shutting down cleanly...")
         sys.exit(0)
 
     def get_gamestate(self) -> melee.GameState:
+        start = self.timer.start()
         gamestate = self.console.step()
         while gamestate is None:
             gamestate = self.console.step()
             print("No gamestate")
+        self.timer.lap('gamestate', start)
 
         # The console object keeps track of how long your bot is taking to process frames
         #   And can warn you if it's taking too long
         # if self.console.processingtime * 1000 > 20:
         #     print("WARNING: Last frame took " + str(self.console.processingtime * 1000) + "ms to process.")
+        if gamestate.menu_state in [melee.Menu.IN_GAME, melee.Menu.SUDDEN_DEATH]:
+            self.timer.frame(self.console.processingtime)
 
         if gamestate.menu_state not in [melee.Menu.IN_GAME, melee.Menu.SUDDEN_DEATH] and self.first_match_started:
             while gamestate.menu_state == gamestate.menu_state.POSTGAME_SCORES:
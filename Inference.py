@@ -0,0 +1,354 @@
+import json
+import os
+import pickle
+import threading
+import time
+
+import melee
+import numpy as np
+
+import Files
+from DataHandler import input_names, output_names, feature_versions
+
+artifact_version = 2
+# Largest difference to the keras model's predictions a converted .pkl may have
+conversion_tolerance = 1e-4
+
+_activations = {
+    'tanh': lambda x: np.tanh(x, out=x),
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'linear': lambda x: x,
+}
+
+
+class NumpyModel:
+    """
+    Forward pass of a stack of Dense layers (as built by train.create_model) in float32 NumPy, without
+    TensorFlow. Buffers are allocated once per batch size, so a predict call allocates nothing.
+    """
+
+    def __init__(self, layers: list, header: dict = None):
+        """layers is a list of (kernel, bias, activation) with kernel shaped (inputs, outputs)"""
+        self.header = header or {}
+        self.layers = []
+        for kernel, bias, activation in layers:
+            if activation not in _activations:
+                raise ValueError(f'Unsupported activation {activation}')
+            self.layers.append((np.ascontiguousarray(kernel, dtype=np.float32),
+                                np.ascontiguousarray(bias, dtype=np.float32),
+                                activation))
+        self.input_size = self.layers[0][0].shape[0]
+        self.output_size = self.layers[-1][0].shape[1]
+        self._batch_size = 0
+        self._buffers = []
+
+    @classmethod
+    def from_keras(cls, model):
+        layers = []
+        for layer in model.layers:
+            config = layer.get_config()
+            if 'units' not in config:
+                raise ValueError(f'Only Dense layers are supported, got {type(layer).__name__}')
+            kernel, bias = layer.get_weights()
+            layers.append((kernel, bias, config['activation']))
+        return cls(layers)
+
+    def _allocate(self, batch_size: int):
+        self._batch_size = batch_size
+        self._input = np.empty((batch_size, self.input_size), dtype=np.float32)
+        self._buffers = [np.empty((batch_size, kernel.shape[1]), dtype=np.float32) for kernel, _, _ in self.layers]
+
+    def predict(self, x: np.ndarray, **kwargs) -> np.ndarray:
+        """
+        Same contract as keras.Model.predict for a (batch, inputs) array. Extra keyword arguments such as verbose
+        are accepted and ignored so this can stand in for a keras model. The returned array is reused by the
+        next call.
+        """
+        if len(x) != self._batch_size:
+            self._allocate(len(x))
+        self._input[...] = x
+        h = self._input
+        for (kernel, bias, activation), out in zip(self.layers, self._buffers):
+            np.matmul(h, kernel, out=out)
+            out += bias
+            _activations[activation](out)
+            h = out
+        return h
+
+
+class QuantizedModel(NumpyModel):
+    """
+    NumpyModel whose weights are stored in reduced precision: int8 kernels with one symmetric scale per layer,
+    or float16 kernels. Biases stay float32. As an artifact it takes a quarter (int8) or half (float16) of the
+    space. NumPy has no int8 or float16 matrix multiply that beats its float32 one, so the kernels are widened to
+    float32 once, here, and predict is NumpyModel's: as fast as the float32 model, with the quantized weights.
+    """
+
+    def __init__(self, layers: list, precision: str, scales: list, header: dict = None):
+        """layers is a list of (quantized kernel, bias, activation), scales has one float per layer"""
+        if precision not in quantized_precisions:
+            raise ValueError(f'Unsupported precision {precision}')
+        self.precision = precision
+        self.scales = [np.float32(scale) for scale in scales]
+        self.quantized_layers = [(np.ascontiguousarray(kernel, dtype=quantized_precisions[precision]), bias, activation)
+                                 for kernel, bias, activation in layers]
+        super().__init__([(kernel.astype(np.float32) * scale, bias, activation)
+                          for (kernel, bias, activation), scale in zip(self.quantized_layers, self.scales)], header)
+
+
+quantized_precisions = {'float16': np.float16, 'int8': np.int8}
+precisions = ['float32'] + list(quantized_precisions)
+
+
+def quantize(model, precision: str) -> QuantizedModel:
+    """Post training quantization of a keras or NumpyModel to 'int8' or 'float16'"""
+    if isinstance(model, QuantizedModel):
+        raise ValueError(f'model is already quantized to {model.precision}')
+    if not isinstance(model, NumpyModel):
+        model = NumpyModel.from_keras(model)
+    layers = []
+    scales = []
+    for kernel, bias, activation in model.layers:
+        if precision == 'int8':
+            scale = max(float(np.abs(kernel).max()), np.finfo(np.float32).tiny) / 127
+            kernel = np.clip(np.round(kernel / scale), -127, 127)
+        else:
+            scale = 1.0
+        layers.append((kernel, bias, activation))
+        scales.append(scale)
+    return QuantizedModel(layers, precision, scales, dict(model.header))
+
+
+def agreement(reference, candidate, X, rows: int = 4096) -> dict:
+    """How often candidate picks the same output as reference (argmax) over the rows of X, in chunks of rows"""
+    same = 0
+    largest = 0.0
+    for start in range(0, len(X), rows):
+        x = np.asarray(X[start:start + rows], dtype=np.float32)
+        expected = np.array(reference.predict(x, verbose=0))
+        actual = np.array(candidate.predict(x, verbose=0))
+        same += int(np.count_nonzero(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+        largest = max(largest, float(np.max(np.abs(expected - actual), initial=0)))
+    return {'rows': len(X), 'argmax_agreement': same / max(len(X), 1), 'max_abs_difference': largest}
+
+
+def weight_bytes(model: NumpyModel) -> int:
+    """Bytes the weights of model take in its artifact"""
+    layers = model.quantized_layers if isinstance(model, QuantizedModel) else model.layers
+    return sum(kernel.nbytes + np.asarray(bias, dtype=np.float32).nbytes for kernel, bias, _ in layers)
+
+
+class _Request:
+    __slots__ = ('model', 'x', 'result', 'error', 'done')
+
+    def __init__(self, model, x: np.ndarray):
+        self.model = model
+        self.x = x
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceBroker:
+    """
+    Batches predict calls from several bots (both ports, or several games each running in its own thread) into one
+    forward pass per model. The first bot to ask in a frame waits until every client has asked too, or until
+    max_wait has passed, then runs the batch for everyone. A lone client never waits.
+    """
+
+    def __init__(self, max_wait: float = 0.002):
+        self.max_wait = max_wait
+        self.clients = 0
+        self.batches = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._pending = []
+        self._collecting = False
+
+    def client(self, model) -> 'BrokerClient':
+        """Returns a stand in for model whose predict calls go through this broker"""
+        with self._lock:
+            self.clients += 1
+        return BrokerClient(self, model)
+
+    def _close(self):
+        with self._lock:
+            self.clients -= 1
+            self._ready.notify()
+
+    def predict(self, model, x: np.ndarray) -> np.ndarray:
+        request = _Request(model, np.asarray(x, dtype=np.float32))
+        with self._lock:
+            self._pending.append(request)
+            if self._collecting:
+                if len(self._pending) >= self.clients:
+                    self._ready.notify()
+                batch = None
+            else:
+                self._collecting = True
+                deadline = time.perf_counter() + self.max_wait
+                while len(self._pending) < self.clients:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._collecting = False
+        if batch is not None:
+            self._run(batch)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self, batch: list):
+        by_model = {}
+        for request in batch:
+            by_model.setdefault(id(request.model), []).append(request)
+        for requests in by_model.values():
+            try:
+                x = np.concatenate([r.x for r in requests])
+                # NumpyModel reuses its output buffer, so every bot gets its own copy of its rows
+                y = np.array(requests[0].model.predict(x, verbose=0))
+                offset = 0
+                for r in requests:
+                    r.result = y[offset:offset + len(r.x)]
+                    offset += len(r.x)
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+            for r in requests:
+                r.done.set()
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+
+
+class BrokerClient:
+    """What a Bot holds in place of its model when it shares an InferenceBroker"""
+
+    def __init__(self, broker: InferenceBroker, model):
+        self.broker = broker
+        self.model = model
+
+    def predict(self, x: np.ndarray, **kwargs) -> np.ndarray:
+        return self.broker.predict(self.model, x)
+
+    def close(self):
+        """Stops the broker from waiting on this client, e.g. when its game ends"""
+        self.broker._close()
+
+
+def save_artifact(path: str, model, **info):
+    """
+    Writes the weights of a keras, NumpyModel or QuantizedModel to a single .npz. A JSON header inside it
+    describes the layers, their precision and the input/output columns, plus anything passed in info
+    (e.g. the matchup).
+    """
+    if not isinstance(model, NumpyModel):
+        model = NumpyModel.from_keras(model)
+    quantized = isinstance(model, QuantizedModel)
+    header = {
+        'artifact_version': artifact_version,
+        'activations': [activation for _, _, activation in model.layers],
+        'precision': model.precision if quantized else 'float32',
+        'scales': [float(scale) for scale in model.scales] if quantized else None,
+        'input_names': input_names,
+        'feature_versions': feature_versions,
+        'output_names': output_names,
+        **info,
+    }
+    arrays = {'header': np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)}
+    for i, (kernel, bias, _) in enumerate(model.quantized_layers if quantized else model.layers):
+        arrays[f'kernel_{i}'] = kernel
+        arrays[f'bias_{i}'] = bias
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_artifact(path: str) -> NumpyModel:
+    with np.load(path, allow_pickle=False) as data:
+        header = json.loads(data['header'].tobytes().decode())
+        if header['artifact_version'] > artifact_version:
+            raise ValueError(f'{path} was written by a newer artifact format ({header["artifact_version"]})')
+        if header['input_names'] != input_names:
+            raise ValueError(f'{path} was trained on different features than DataHandler.generate_input produces')
+        if header.get('feature_versions', feature_versions) != feature_versions:
+            raise ValueError(f'{path} was trained on other versions of the features than DataHandler computes')
+        layers = [(data[f'kernel_{i}'], data[f'bias_{i}'], activation)
+                  for i, activation in enumerate(header['activations'])]
+    precision = header.get('precision', 'float32')
+    if precision != 'float32':
+        return QuantizedModel(layers, precision, header['scales'], header)
+    return NumpyModel(layers, header)
+
+
+def model_name(player_character: melee.Character, opponent_character: melee.Character, stage: melee.Stage):
+    return f'{player_character.name}_v_{opponent_character.name}_on_{stage.name}'
+
+
+class ModelRegistry:
+    """
+    Loads models from folder on first use and keeps them, keyed by (character, opponent, stage), so a long
+    running bot can switch matchups between games without touching the disk again. Weight artifacts (.npz)
+    are preferred. A pickled keras model is only unpickled (pulling in TensorFlow) when no artifact exists,
+    and is then converted and saved as an artifact for next time. With a precision other than float32 the
+    quantized artifact (<name>_<precision>.npz) is used. It is made from the float32 artifact and remembers that
+    artifact's file_key, so it is made again once the float32 model was retrained.
+    """
+
+    def __init__(self, folder: str = 'models2', precision: str = 'float32'):
+        if precision not in precisions:
+            raise ValueError(f'precision must be one of {precisions}, not {precision}')
+        self.folder = folder
+        self.precision = precision
+        self.models = {}
+
+    def get(self, player_character: melee.Character, opponent_character: melee.Character,
+            stage: melee.Stage) -> NumpyModel:
+        key = (player_character, opponent_character, stage)
+        if key not in self.models:
+            self.models[key] = self._load(*key)
+        return self.models[key]
+
+    def _load(self, player_character: melee.Character, opponent_character: melee.Character, stage: melee.Stage):
+        reference = self._load_float32(player_character, opponent_character, stage)
+        if self.precision == 'float32':
+            return reference
+        name = model_name(player_character, opponent_character, stage)
+        path = f'{self.folder}/{name}_{self.precision}.npz'
+        source = Files.file_key(f'{self.folder}/{name}.npz')
+        if os.path.exists(path):
+            model = load_artifact(path)
+            if model.header.get('source') == source:
+                return model
+            print(f'{path} was quantized from an older {name}.npz, quantizing it again')
+        save_artifact(path, quantize(reference, self.precision), player_character=player_character.name,
+                      opponent_character=opponent_character.name, stage=stage.name, source=source)
+        return load_artifact(path)
+
+    def _load_float32(self, player_character: melee.Character, opponent_character: melee.Character,
+                      stage: melee.Stage):
+        path = f'{self.folder}/{model_name(player_character, opponent_character, stage)}'
+        if os.path.exists(path + '.npz'):
+            return load_artifact(path + '.npz')
+        if not os.path.exists(path + '.pkl'):
+            raise FileNotFoundError(f'No model at {path}.npz or {path}.pkl')
+        with open(path + '.pkl', 'rb') as file:
+            keras_model = pickle.load(file)
+        model = NumpyModel.from_keras(keras_model)
+        # Only write the artifact if it predicts what the keras model does
+        X = np.random.default_rng(0).uniform(-1, 1, (64, model.input_size)).astype(np.float32)
+        difference = max_difference(keras_model, model, X)
+        if difference > conversion_tolerance:
+            raise ValueError(f'{path}.pkl converted to numpy differs from keras by up to {difference}')
+        save_artifact(path + '.npz', model, player_character=player_character.name,
+                      opponent_character=opponent_character.name, stage=stage.name)
+        return load_artifact(path + '.npz')
+
+
+def max_difference(a, b, X: np.ndarray) -> float:
+    """Largest absolute difference between the predictions of two models on X"""
+    return float(np.max(np.abs(np.array(a.predict(X, verbose=0)) - np.array(b.predict(X, verbose=0)))))
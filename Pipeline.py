@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+import melee
+
+import Timing
+from Bot import Bot
+
+# What PipelinedBot does on a frame where the move for the previous frame isn't ready yet:
+#   drop   leave the controller alone and throw the move away once it arrives
+#   reuse  send the last move again and throw the late one away once it arrives
+#   late   leave the controller alone and send the move on the first frame after it arrives
+late_policies = ['drop', 'reuse', 'late']
+
+
+class PipelinedBot:
+    """
+    Runs bot.decide for frame N on a worker thread while the main thread polls frame N+1, then applies the
+    move on the main thread. Moves therefore reach the controller one frame after the gamestate they were
+    decided on, but a slow predict no longer holds up polling. The outcome of every frame is counted in
+    the bot's timer as pipeline_<outcome> and shows up in its latency dump.
+    """
+
+    def __init__(self, bot: Bot, policy: str = 'reuse', wait: float = Timing.frame_budget / 8):
+        if policy not in late_policies:
+            raise ValueError(f'late policy must be one of {late_policies}, not {policy}')
+        self.bot = bot
+        self.policy = policy
+        # How long step waits for the move after the gamestate arrived before calling it late
+        self.wait = wait
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='decide')
+        self.pending = None
+        self.pending_late = False
+        self.last_commands = []
+
+    @property
+    def timer(self) -> Timing.FrameTimer:
+        return self.bot.timer
+
+    def step(self, gamestate: melee.GameState):
+        """Call once per polled frame instead of bot.act"""
+        start = self.timer.start()
+        if self.pending is not None:
+            self._collect()
+        if self.pending is None:
+            self.pending = self.executor.submit(self._decide, gamestate)
+            self.pending_late = False
+        self.timer.lap('pipeline_step', start)
+
+    def _decide(self, gamestate: melee.GameState) -> list:
+        start = self.timer.start()
+        commands = self.bot.decide(gamestate)
+        self.timer.lap('decide', start)
+        return commands
+
+    def _collect(self):
+        try:
+            commands = self.pending.result(timeout=0 if self.pending_late else self.wait)
+        except TimeoutError:
+            if not self.pending_late:
+                self.pending_late = True
+                self.timer.count('pipeline_late')
+            if self.policy == 'reuse':
+                self._apply(self.last_commands)
+                self.timer.count('pipeline_reused')
+            return
+
+        late = self.pending_late
+        self.pending = None
+        if not late:
+            self.timer.count('pipeline_on_time')
+        elif self.policy == 'late':
+            self.timer.count('pipeline_applied_late')
+        else:
+            self.timer.count('pipeline_dropped')
+            return
+        self._apply(commands)
+        self.last_commands = commands
+
+    def _apply(self, commands: list):
+        start = self.timer.start()
+        self.bot.apply(commands)
+        self.timer.lap('apply', start)
+
+    def close(self, timeout: float = 1.0):
+        """
+        Stops the worker thread, giving the decide in flight up to timeout seconds to finish. It isn't waited on
+        forever, close may be called from a signal handler that interrupted a thread the decide is waiting for.
+        """
+        self.executor.shutdown(wait=False)
+        if self.pending is not None:
+            wait([self.pending], timeout)
@@ -0,0 +1,253 @@
+import atexit
+import contextlib
+import cProfile
+import csv
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+frame_budget = 1 / 60
+
+
+class RollingHistogram:
+    """Keeps the last window samples (in seconds) in a ring buffer, plus the all time count and max"""
+
+    def __init__(self, window: int):
+        self.samples = np.zeros(window)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self) -> dict:
+        recent = self.samples[:min(self.count, len(self.samples))]
+        if len(recent) == 0:
+            return {'count': 0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+        p50, p99 = np.percentile(recent, [50, 99])
+        return {'count': self.count, 'p50_ms': p50 * 1000, 'p99_ms': p99 * 1000, 'max_ms': self.max * 1000}
+
+
+class FrameTimer:
+    """
+    Cheap named timers for the bot loop. Time a section with
+        t = timer.start()
+        ...
+        t = timer.lap('section', t)
+    lap records the time since t and returns the current time, so consecutive sections can be chained.
+    A pipelined bot times its sections from a worker thread, so recording and summarizing take a lock. It is
+    reentrant since the ^C handler dumps the timer on the main thread, possibly in the middle of an add.
+    """
+
+    def __init__(self, window: int = 3600, budget: float = frame_budget):
+        self.window = window
+        self.budget = budget
+        self.sections = {}
+        self.counters = {}
+        self.over_budget = 0
+        self.lock = threading.RLock()
+
+    def start(self) -> float:
+        return time.perf_counter()
+
+    def lap(self, name: str, start: float) -> float:
+        now = time.perf_counter()
+        self.add(name, now - start)
+        return now
+
+    def add(self, name: str, seconds: float):
+        if profiler is not None:
+            profiler.add(name, seconds)
+        with self.lock:
+            histogram = self.sections.get(name)
+            if histogram is None:
+                histogram = self.sections[name] = RollingHistogram(self.window)
+            histogram.add(seconds)
+
+    def count(self, name: str, n: int = 1):
+        """Bumps a named event counter, e.g. how often the pipelined loop got a result late"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def frame(self, seconds: float):
+        """Records the total processing time of one frame and counts it if it went over budget"""
+        self.add('frame', seconds)
+        if seconds > self.budget:
+            with self.lock:
+                self.over_budget += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            frames = self.sections['frame'].count if 'frame' in self.sections else 0
+            return {
+                'budget_ms': self.budget * 1000,
+                'frames': frames,
+                'frames_over_budget': self.over_budget,
+                'counters': dict(self.counters),
+                'sections': {name: h.summary() for name, h in self.sections.items()},
+            }
+
+    def dump(self, prefix: str):
+        """Writes the summary to prefix.json and one row per section to prefix.csv"""
+        summary = self.summary()
+        with open(f'{prefix}.json', 'w') as file:
+            json.dump(summary, file, indent=2)
+        with open(f'{prefix}.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['section', 'count', 'p50_ms', 'p99_ms', 'max_ms'])
+            for name, s in summary['sections'].items():
+                writer.writerow([name, s['count'], s['p50_ms'], s['p99_ms'], s['max_ms']])
+        print(f'{summary["frames_over_budget"]} of {summary["frames"]} frames over budget, '
+              f'latency written to {prefix}.json and {prefix}.csv')
+
+
+class StageProfiler:
+    """
+    Cumulative calls and seconds of every named stage over a whole run, for --profile. Unlike FrameTimer it
+    keeps no per call samples, and it can be fed from several threads.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0, 0.0]
+            stage[0] += 1
+            stage[1] += seconds
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self.started
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        return {
+            'wall_s': wall,
+            'stages': {name: {'calls': calls, 'total_s': total, 'mean_ms': total / calls * 1000,
+                              'share_of_wall': total / wall if wall else 0.0}
+                       for name, (calls, total) in stages},
+        }
+
+    def dump(self, prefix: str):
+        """Writes the summary to prefix.json and prints it, slowest stage first"""
+        summary = self.summary()
+        with open(f'{prefix}.json', 'w') as file:
+            json.dump(summary, file, indent=2)
+        print(f'{"stage":<24} {"calls":>10} {"total_s":>10} {"mean_ms":>10} {"share":>7}')
+        for name, s in summary['stages'].items():
+            print(f'{name:<24} {s["calls"]:>10} {s["total_s"]:>10.3f} {s["mean_ms"]:>10.4f} '
+                  f'{s["share_of_wall"]:>7.1%}')
+        print(f'{summary["wall_s"]:.3f}s wall, stage breakdown written to {prefix}.json')
+
+
+class StackSampler:
+    """
+    Statistical profiler: a daemon thread wakes up every interval seconds and records the Python stack of every
+    other thread. Time spent in C code (e.g. numpy, libmelee's parsing) shows up on the Python frame that called
+    it. The overhead does not depend on how many functions run, so stage timings stay meaningful.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path: str):
+        """
+        Writes the samples as collapsed stacks ('outer;inner count' per line, as flamegraph.pl and speedscope
+        read them) and prints the functions most samples were in
+        """
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = max(sum(leaves.values()), 1)
+        for leaf, count in leaves.most_common(15):
+            print(f'{count / total:>7.1%} {leaf}')
+        print(f'{total} samples written to {path}')
+
+
+# The profiler of a --profile run, None otherwise. FrameTimer sections and stage() blocks are added to it.
+profiler: StageProfiler = None
+_not_profiling = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, traceback):
+        profiler.add(self.name, time.perf_counter() - self.start)
+
+
+def stage(name: str):
+    """
+    with Timing.stage('name'): ... adds the block's time to the profiler. Does next to nothing unless
+    start_profiling was called, so stages can stay in hot loops.
+    """
+    return _not_profiling if profiler is None else _Stage(name)
+
+
+def start_profiling(prefix: str = 'profile', sampler: str = 'sample'):
+    """
+    Times stages from now on, and runs sampler ('sample' for StackSampler, 'cprofile' or 'none') alongside.
+    At exit the stage breakdown is written to prefix.json and the profile to prefix.stacks or prefix.prof.
+    """
+    global profiler
+    profiler = StageProfiler()
+    profile = None
+    if sampler == 'sample':
+        profile = StackSampler()
+        profile.start()
+    elif sampler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+
+    def finish():
+        if isinstance(profile, StackSampler):
+            profile.stop()
+            profile.dump(f'{prefix}.stacks')
+        elif profile is not None:
+            profile.disable()
+            profile.dump_stats(f'{prefix}.prof')
+            print(f'cProfile stats written to {prefix}.prof')
+        profiler.dump(prefix)
+
+    atexit.register(finish)
@@ -0,0 +1,95 @@
+import contextlib
+import multiprocessing
+import os
+import signal
+import threading
+
+
+# How imap_with_timeout's errors for jobs that ran out of time start
+timed_out = 'timed out'
+
+
+def is_timeout(error: str) -> bool:
+    """Whether an error from imap_with_timeout means the job ran out of time, rather than failed"""
+    return error is not None and error.startswith(timed_out)
+
+
+class JobTimeout(Exception):
+    """Raised inside a job that ran past time_limit"""
+
+
+@contextlib.contextmanager
+def time_limit(seconds: float = None):
+    """
+    Raises JobTimeout in the block once it ran for seconds, for jobs run in this process. It relies on SIGALRM,
+    so it does nothing on Windows or off the main thread, where only imap_with_timeout's pool can stop a job.
+    """
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expired(signum, frame):
+        raise JobTimeout(f'{timed_out} after {seconds}s')
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def imap_with_timeout(func, jobs: list, workers: int, timeout: float = None, in_flight: int = None):
+    """
+    Yields (job, result, error) for every job, in the order of jobs, running func(job) on a pool of worker
+    processes. A job that raises reports the exception as error. A job that takes longer than timeout seconds
+    is reported as timed out and the pool is restarted, so a hung replay can't hold a worker forever.
+    Results that were already finished when the pool was restarted are kept.
+    Only in_flight jobs (2 per worker by default) are handed to the pool at a time and a result is let go of once
+    it is yielded, so finished results that wait on a slow one don't pile up in memory.
+    """
+    jobs = list(jobs)
+    if in_flight is None:
+        in_flight = 2 * workers
+    done = {}
+    start = 0
+    while start < len(jobs):
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = {}
+            submitted = start
+            restart = False
+            while start < len(jobs) and not restart:
+                while submitted < len(jobs) and len(pending) + len(done) < in_flight:
+                    if submitted not in done:
+                        pending[submitted] = pool.apply_async(func, (jobs[submitted],))
+                    submitted += 1
+
+                i = start
+                if i not in done:
+                    try:
+                        done[i] = (pending.pop(i).get(timeout), None)
+                    except multiprocessing.TimeoutError:
+                        done[i] = (None, f'{timed_out} after {timeout}s')
+                        restart = True
+                    except Exception as e:
+                        done[i] = (None, repr(e))
+                result, error = done.pop(i)
+                yield jobs[i], result, error
+                start += 1
+
+            if restart:
+                for j, r in pending.items():
+                    if r.ready():
+                        try:
+                            done[j] = (r.get(), None)
+                        except Exception as e:
+                            done[j] = (None, repr(e))
+        finally:
+            pool.terminate()
+            pool.join()
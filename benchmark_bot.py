@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+import contextlib
+import json
+import os
+import sys
+import time
+
+import melee
+
+import Args
+import Inference
+import Timing
+from Bot import Bot
+
+args = Args.get_args()
+
+
+class RecordingController:
+    """
+    Stands in for melee.Controller without a console. Keeps the pressed buttons and stick positions, and every
+    flush appends them to log so two runs of a bot can be compared input by input.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.buttons = set()
+        self.main_stick = (0.5, 0.5)
+        self.c_stick = (0.5, 0.5)
+        self.log = []
+        self.frame = -1
+
+    def press_button(self, button: melee.Button):
+        self.buttons.add(button)
+
+    def release_button(self, button: melee.Button):
+        self.buttons.discard(button)
+
+    def tilt_analog_unit(self, button: melee.Button, x: float, y: float):
+        # Same mapping as melee.Controller: -1..1 to 0..1
+        self.tilt_analog(button, (x / 2) + 0.5, (y / 2) + 0.5)
+
+    def tilt_analog(self, button: melee.Button, x: float, y: float):
+        if button == melee.Button.BUTTON_MAIN:
+            self.main_stick = (float(x), float(y))
+        else:
+            self.c_stick = (float(x), float(y))
+
+    def release_all(self):
+        self.buttons.clear()
+        self.main_stick = (0.5, 0.5)
+        self.c_stick = (0.5, 0.5)
+
+    def flush(self):
+        self.log.append({'frame': self.frame, 'buttons': sorted(b.name for b in self.buttons),
+                         'main_stick': self.main_stick, 'c_stick': self.c_stick})
+
+
+def load_gamestates(path: str):
+    """
+    Reads every in game frame of a two player replay. The bot plays the first port, returns
+    (gamestates, player_port, opponent_port, player_character, opponent_character).
+    """
+    console = melee.Console(is_dolphin=False,
+                            allow_old_version=True,
+                            path=path)
+    console.connect()
+    gamestates = []
+    gamestate: melee.GameState = console.step()
+    ports = [] if gamestate is None else list(gamestate.players.keys())
+    if len(ports) != 2:
+        console.stop()
+        raise ValueError(f'{path} is not a two player replay')
+    player_port, opponent_port = ports
+    player_character = gamestate.players[player_port].character
+    opponent_character = gamestate.players[opponent_port].character
+    while gamestate is not None and gamestate.stage is not None:
+        gamestates.append(gamestate)
+        gamestate = console.step()
+    console.stop()
+    return gamestates, player_port, opponent_port, player_character, opponent_character
+
+
+def run(bot: Bot, gamestates: list, quiet: bool = True) -> float:
+    """Feeds gamestates to bot.act one by one, returns the wall time spent in act"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        start = time.perf_counter()
+        for gamestate in gamestates:
+            bot.controller.frame = gamestate.frame
+            bot.act(gamestate)
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    if not args.replay:
+        sys.exit('benchmark_bot.py plays a bot through a replay, pass one with --replay')
+    if not os.path.exists(args.replay):
+        sys.exit(f'No replay at {args.replay}')
+    gamestates, player_port, opponent_port, player_character, opponent_character = load_gamestates(args.replay)
+    stage = gamestates[0].stage
+    print(f'{len(gamestates)} frames of {player_character.name} vs. {opponent_character.name} on {stage.name}')
+
+    registry = Inference.ModelRegistry('models2', precision=args.precision)
+    model = registry.get(player_character, opponent_character, stage)
+    timer = Timing.FrameTimer(window=len(gamestates))
+    bot = Bot(model=model, controller=RecordingController(player_port),
+              opponent_controller=RecordingController(opponent_port), timer=timer)
+
+    elapsed = run(bot, gamestates)
+
+    summary = timer.summary()
+    decisions = summary['sections'].get('inference', {'count': 0})['count']
+    report = {
+        'frames': len(gamestates),
+        'decisions': decisions,
+        'frames_per_second': len(gamestates) / elapsed,
+        'decisions_per_second': decisions / elapsed,
+        'sections': summary['sections'],
+    }
+    print(json.dumps(report, indent=2))
+    if args.latency_log:
+        with open(f'{args.latency_log}_benchmark.json', 'w') as file:
+            json.dump({**report, 'inputs': bot.controller.log}, file, indent=2)
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+import sys
+from collections import deque
+
+import melee
+import numpy as np
+
+import Args
+from DataHandler import generate_input, generate_input_batch, get_player_obs, get_player_obs_batch, \
+    generate_output, generate_output_batch, controller_states_different, controller_states_different_batch, \
+    decode_from_model, decode_from_model_batch, snapshot, player_columns, input_names, player_obs_names, \
+    output_names
+from generate_data import history_filter
+
+args = Args.get_args()
+
+# The per frame functions the bot plays with and the batch functions datasets are built with must give the same
+# numbers, or a model sees different features in play than it was trained on. This feeds the same frames to
+# both and reports every column that differs. With --replay the frames come from that replay, otherwise from
+# random but valid PlayerStates.
+
+characters = [melee.Character.FOX, melee.Character.FALCO, melee.Character.MARTH, melee.Character.CPTFALCON,
+              melee.Character.JIGGLYPUFF]
+actions = [a for a in melee.Action if a != melee.Action.UNKNOWN_ANIMATION]
+
+
+def _stick(rng: np.random.Generator):
+    # The way libmelee computes a stick from the replay, sometimes right on a threshold
+    value = rng.choice([-0.6, 0.6, rng.uniform(-1, 1)])
+    return (np.float32(value) / 2) + 0.5
+
+
+def random_player(rng: np.random.Generator) -> melee.PlayerState:
+    player = melee.PlayerState()
+    player.character = characters[rng.integers(len(characters))]
+    player.action = actions[rng.integers(len(actions))]
+    player.action_frame = int(rng.integers(0, 60))
+    player.position.x = np.float32(rng.uniform(-120, 120))
+    player.position.y = np.float32(rng.uniform(-60, 80))
+    player.x, player.y = player.position.x, player.position.y
+    player.shield_strength = np.float32(rng.uniform(0, 60))
+    for name in ['speed_air_x_self', 'speed_y_self', 'speed_x_attack', 'speed_y_attack', 'speed_ground_x_self']:
+        setattr(player, name, np.float32(rng.normal(0, 2)))
+    player.facing = bool(rng.integers(2))
+    player.on_ground = bool(rng.integers(2))
+    player.hitlag_left = int(rng.choice([0, 0, 0, rng.integers(1, 10)]))
+    player.invulnerable = bool(rng.integers(2))
+    player.jumps_left = np.uint8(rng.integers(0, 3))
+    controller: melee.ControllerState = player.controller_state
+    for button in controller.button:
+        controller.button[button] = bool(rng.random() < 0.1)
+    controller.main_stick = (_stick(rng), _stick(rng))
+    controller.c_stick = (_stick(rng), _stick(rng))
+    return player
+
+
+def synthetic_frames(count: int, seed: int = 0):
+    """count random (player, opponent) PlayerState pairs on Final Destination"""
+    rng = np.random.default_rng(seed)
+    return [random_player(rng) for _ in range(count)], [random_player(rng) for _ in range(count)], \
+           melee.Stage.FINAL_DESTINATION
+
+
+def replay_frames(path: str):
+    """The (player, opponent) PlayerStates of every frame of a two player replay, in port order"""
+    console = melee.Console(is_dolphin=False, allow_old_version=True, path=path)
+    console.connect()
+    players, opponents = [], []
+    gamestate: melee.GameState = console.step()
+    ports = list(gamestate.players.keys())
+    stage = gamestate.stage
+    while gamestate is not None and gamestate.stage is not None:
+        states = [gamestate.players.get(port) for port in ports]
+        if None in states:
+            break
+        players.append(states[0])
+        opponents.append(states[1])
+        gamestate = console.step()
+    console.stop()
+    return players, opponents, stage
+
+
+def _report(name: str, columns: list, scalar: np.ndarray, batch: np.ndarray) -> int:
+    """Prints the columns where scalar and batch differ, returns how many there are"""
+    different = [column for i, column in enumerate(columns) if not np.array_equal(scalar[:, i], batch[:, i])]
+    print(f'{name}: {len(scalar)} frames, ' + (f'{len(different)} columns differ: {different}' if different
+                                                  else 'identical'))
+    return len(different)
+
+
+def check_inputs(players: list, opponents: list, stage: melee.Stage) -> int:
+    """generate_input and get_player_obs against generate_input_batch and get_player_obs_batch"""
+    scalar = np.array([generate_input(_FrameState(player, opponent, stage), 1, 2)
+                       for player, opponent in zip(players, opponents)])
+    batch = generate_input_batch(player_columns(players), player_columns(opponents), stage)
+    failures = _report('generate_input', input_names, scalar, batch)
+
+    gamestate = _FrameState(None, None, stage)
+    scalar = np.array([get_player_obs(player, gamestate) for player in players], dtype=np.float64)
+    batch = get_player_obs_batch(player_columns(players), stage)
+    return failures + _report('get_player_obs', player_obs_names, scalar, batch)
+
+
+def check_controller(players: list, opponents: list) -> int:
+    """controller_states_different, on PlayerStates and on snapshots, against controller_states_different_batch"""
+    batch = controller_states_different_batch(player_columns(players), player_columns(opponents))[:, None]
+    scalar = np.array([[controller_states_different(player, opponent)] for player, opponent in zip(players, opponents)])
+    failures = _report('controller_states_different', ['different'], scalar, batch)
+    scalar = np.array([[controller_states_different(player, snapshot(opponent))]
+                       for player, opponent in zip(players, opponents)])
+    return failures + _report('controller_states_different (snapshot)', ['different'], scalar, batch)
+
+
+def history_filter_loop(actions: list) -> list:
+    """The frame by frame action history filter history_filter replaced, the frames where an action is recorded"""
+    history = deque(maxlen=3)
+    last_recorded = -1
+    recorded = []
+    for frame, action in enumerate(actions):
+        if action == -1:
+            continue
+        history.append(action)
+        if action != last_recorded:
+            if history[-1] < 11 and history[0] >= 11:
+                pass
+            elif history[-1] >= 11 and history[0] < 11 or (history[-1] == history[0] and history[0] < 11):
+                recorded.append(frame)
+                last_recorded = action
+    return recorded
+
+
+def check_outputs(players: list, seed: int = 0) -> int:
+    """generate_output against generate_output_batch, and the history filter loop against history_filter"""
+    scalar = np.array([[generate_output(player)] for player in players])
+    batch = generate_output_batch(player_columns(players))[:, None]
+    failures = _report('generate_output', ['action'], scalar, batch)
+
+    # Random frames hardly ever repeat an action, so the filter also gets runs of them
+    rng = np.random.default_rng(seed)
+    runs = np.repeat(batch[:, 0], rng.integers(1, 6, len(batch)))
+    for name, actions in [('history_filter', batch[:, 0]), ('history_filter (runs)', runs)]:
+        scalar = history_filter_loop(list(actions))
+        recorded = history_filter(actions)
+        same = np.array_equal(scalar, recorded)
+        print(f'{name}: {len(actions)} frames, ' + ('identical' if same else
+                                                    f'{len(scalar)} frames recorded frame by frame, {len(recorded)} '
+                                                    f'by history_filter'))
+        failures += not same
+    return failures
+
+
+def check_decode(players: list, stage: melee.Stage, seed: int = 0) -> int:
+    """decode_from_model against decode_from_model_batch on random predictions for the same frames"""
+    rng = np.random.default_rng(seed)
+    # Like the model's tanh outputs, with b_up winning often enough to reach Marth's recovery
+    predictions = rng.uniform(-1, 1, (len(players), len(output_names))).astype(np.float32)
+    predictions[rng.random(len(players)) < 0.25, 14] = 1
+
+    decoded = [decode_from_model(prediction[None], player, stage) for prediction, player in zip(predictions, players)]
+    scalar = np.array([[a, *buttons, *sticks] for a, (buttons, *sticks) in decoded], dtype=np.float64)
+    a, buttons, sticks = decode_from_model_batch(predictions, player_columns(players), stage)
+    batch = np.column_stack([a, buttons, sticks]).astype(np.float64)
+    return _report('decode_from_model', ['action', 'BUTTON_X', 'BUTTON_B', 'BUTTON_L', 'BUTTON_A', 'BUTTON_Z',
+                                         'move_x', 'move_y', 'c_x', 'c_y'], scalar, batch)
+
+
+class _FrameState:
+    """The parts of a GameState generate_input reads: players on ports 1 and 2 and the stage"""
+
+    def __init__(self, player: melee.PlayerState, opponent: melee.PlayerState, stage: melee.Stage):
+        self.players = {1: player, 2: opponent}
+        self.stage = stage
+
+
+if __name__ == '__main__':
+    if args.replay:
+        players, opponents, stage = replay_frames(args.replay)
+    else:
+        players, opponents, stage = synthetic_frames(20000)
+
+    failures = check_inputs(players, opponents, stage)
+    failures += check_controller(players, opponents)
+    failures += check_outputs(players)
+    failures += check_decode(players, stage)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+import Args
+import Dataset
+
+args = Args.get_args()
+
+
+if __name__ == '__main__':
+    total_before = 0
+    total_after = 0
+    for matchup in Dataset.find_datasets():
+        path = Dataset.load_dataset(*matchup).path
+        before, after = Dataset.compact_dataset(path, step=args.compact_step,
+                                                 validation_split=args.validation_split)
+        total_before += before
+        total_after += after
+        print(f'{path}: {before} -> {after} rows ({after / max(before, 1):.1%})')
+    print(f'All datasets: {total_before} -> {total_after} rows ({total_after / max(total_before, 1):.1%})')
@@ -1,11 +1,13 @@
 import math
 import pickle
 import time
-
-import keras
+from concurrent.futures import ThreadPoolExecutor
 
 import Args
 import GameManager
+import Inference
+import Pipeline
+import Timing
 import melee
 import platform
 
@@ -37,21 +39,73 @@ def load_model(path: str):
         quit()
 
 
+def share_models(bots: list):
+    """
+    Bots that play with the same model ask one InferenceBroker for their moves, so they are answered by a single
+    forward pass per frame. A bot with a model of its own keeps calling it directly, since going through the
+    broker's thread costs more than the forward pass itself.
+    """
+    by_model = {}
+    for bot in bots:
+        by_model.setdefault(id(bot.model), []).append(bot)
+    shared = [group for group in by_model.values() if len(group) > 1]
+    if shared:
+        broker = Inference.InferenceBroker()
+        for group in shared:
+            for bot in group:
+                bot.model = broker.client(bot.model)
+
+
 if __name__ == '__main__':
-    file_name = f'models2/{player_character.name}_v_{opponent_character.name}_on_{stage.name}.pkl'
-    # file_name = 'generated_models/old/FALCO_v_FALCO_on_FINAL_DESTINATION.pkl_9.pkl'
-    print(file_name)
+    if args.profile:
+        # Every FrameTimer section of the game and the bots is added up as a stage
+        Timing.start_profiling(args.profile_output, args.profiler)
+
+    # Weight artifacts load without TensorFlow, the registry keeps models around across matchups
+    registry = Inference.ModelRegistry('models2', precision=args.precision)
+    keras_models = {}
+
+    def matchup_model(character: melee.Character, opponent: melee.Character):
+        if args.inference != 'keras':
+            return registry.get(character, opponent, stage)
+        # Unpickling the keras model is what imports TensorFlow, the numpy backend never does
+        file_name = f'models2/{character.name}_v_{opponent.name}_on_{stage.name}.pkl'
+        print(file_name)
+        if file_name not in keras_models:
+            keras_models[file_name] = load_model(file_name)
+        return keras_models[file_name]
 
-    model: keras.Model = load_model(file_name)
     game = GameManager.Game(args)
-    game.enterMatch(cpu_level=level, opponant_character=opponent_character,
+    # With --self_play the opponent port is a second bot rather than a CPU
+    game.enterMatch(cpu_level=0 if args.self_play else level, opponant_character=opponent_character,
                     player_character=player_character,
                     stage=stage, rules=False)
 
-    bot1 = Bot(model=model, controller=game.controller, opponent_controller=game.opponent_controller)
-    # bot2 = Bot(model=model, controller=game.opponent_controller, opponent_controller=game.controller)
+    bot1 = Bot(model=matchup_model(player_character, opponent_character), controller=game.controller,
+               opponent_controller=game.opponent_controller, timer=game.timer)
+    bots = [bot1]
+    if args.self_play:
+        # In a ditto both bots get the same model and so share one forward pass per frame
+        bots.append(Bot(model=matchup_model(opponent_character, player_character), controller=game.opponent_controller,
+                        opponent_controller=game.controller, timer=game.timer))
+    share_models(bots)
+
+    if args.pipeline:
+        # Each bot decides on its own worker thread while the next frame is polled
+        pipelined = [Pipeline.PipelinedBot(bot, policy=args.late_policy, wait=args.pipeline_wait) for bot in bots]
+        # Let the last decide finish before the timer it writes to is dumped
+        game.on_exit.extend(bot.close for bot in pipelined)
+        while True:
+            gamestate = game.get_gamestate()
+            for bot in pipelined:
+                bot.step(gamestate)
+
+    if len(bots) == 1:
+        # A single bot acts on the main thread, handing it to an executor would only add latency
+        while True:
+            bot1.act(game.get_gamestate())
 
-    while True:
-        gamestate = game.get_gamestate()
-        bot1.act(gamestate)
-        # bot2.act(gamestate)
\ No newline at end of file
+    with ThreadPoolExecutor(len(bots)) as executor:
+        while True:
+            gamestate = game.get_gamestate()
+            list(executor.map(lambda bot: bot.act(gamestate), bots))
@@ -1,9 +1,7 @@
 #!/usr/bin/python3
-import copy
-from collections import deque
-
 import melee
 
+import hashlib
 import os
 import json
 
@@ -12,142 +10,363 @@ from tqdm import tqdm
 import time
 import numpy as np
 
-from tensorflow import keras
-from keras.models import Sequential
-from keras.layers import Dense
-import pickle
-
+import ActionTables
 import Args
-from DataHandler import get_ports, controller_states_different, generate_input, generate_output
-import MovesList
+import Dataset
+from DataHandler import generate_input_batch, generate_output_batch, controller_states_different_batch, \
+    input_names, output_names, feature_versions
+import Files
+import FrameCache
+import Timing
+from Workers import imap_with_timeout, is_timeout, time_limit, JobTimeout
 
 args = Args.get_args()
 
-def load_data(replay_paths: str, player_character: melee.Character, opponent_character: melee.Character, ):
-    X_player = []
-    Y_player = []
+# Per matchup progress of load_data, so an interrupted run picks up where it stopped
+checkpoint_folder = 'Data/checkpoints'
+# Input signature of every matchup whose datasets are written, see process_replays
+completed_path = 'Data/completed.json'
+
+def load_replay(path: str, player_character: melee.Character, opponent_character: melee.Character,
+                cache_folder: str = None):
+    """
+    Returns X, Y, source for the player's samples, the labels Y being action ids (indices into output_names).
+    source holds the replay's hash, the player's slot in the frame cache and the frame every row was taken from,
+    so its columns can be recomputed later. The opponent's dataset is a copy of the player's (see load_data), so
+    no opponent samples are computed or sent back from the workers.
+    """
+    if cache_folder is None:
+        cache_folder = args.frame_cache
+    frames = FrameCache.load(path, cache_folder)
+    player_slot, opponent_slot = frames.slots(player_character, opponent_character)
+    if player_slot == -1:
+        raise RuntimeError(f'bad port {frames.ports}')
+
+    # Frame 0 is only what the first sample's controller state is compared against. Of the frames after it,
+    # every one where the player isn't dead can become a sample. Labels, the action history filter and the
+    # observations are computed for the whole replay at once.
+    with Timing.stage('select_frames'):
+        first_player = _rows(frames.players[player_slot], slice(0, 1))
+        dead = ActionTables.dead_table[ActionTables.slot(frames.players[player_slot]['action'][1:])]
+        alive = 1 + np.flatnonzero(~dead)
+        player = _rows(frames.players[player_slot], alive)
+        opponent = _rows(frames.players[opponent_slot], alive)
+
+    source = {'hash': frames.replay_hash, 'player_slot': player_slot}
+    if len(alive) == 0:
+        source.update(player_frames=np.empty(0, dtype=np.int32))
+        return np.empty((0, len(input_names))), np.empty(0, dtype=np.uint8), source
+
+    with Timing.stage('generate_output'):
+        actions = generate_output_batch(player)
+    with Timing.stage('history_filter'):
+        recorded = history_filter(actions)
+    with Timing.stage('controller_states_different'):
+        last_recorded = {name: np.concatenate([first_player[name], player[name][recorded[:-1]]]) for name in player}
+        rows = recorded[controller_states_different_batch(_rows(player, recorded), last_recorded)]
+
+    # Every observation depends on its own frame only, so just the sampled frames are computed
+    with Timing.stage('generate_input'):
+        obs = generate_input_batch(_rows(player, rows), _rows(opponent, rows), frames.stage)
+    source.update(player_frames=alive[rows])
+
+    return obs, actions[rows].astype(np.uint8), source
+
+
+def history_filter(actions: np.ndarray) -> np.ndarray:
+    """
+    Frames where an action from generate_output_batch gets recorded. Looking at the last three actions, one is
+    kept when the oldest is not a b or a move (id < 11) and the newest either repeats it or is a b or a move,
+    and only when it differs from the action recorded before it.
+    """
+    frames = np.flatnonzero(actions != -1)
+    history = actions[frames]
+    # The action two actions back, or the first one while fewer than three have been seen
+    first = history[np.maximum(np.arange(len(history)) - 2, 0)]
+    accepted = (first < 11) & ((history >= 11) | (history == first))
+    frames, history = frames[accepted], history[accepted]
+
+    changed = np.ones(len(history), dtype=bool)
+    changed[1:] = history[1:] != history[:-1]
+    return frames[changed]
+
+
+def _rows(columns: dict, rows) -> dict:
+    return {name: column[rows] for name, column in columns.items()}
+
+
+def _load_replay_job(job):
+    path, player_character, opponent_character = job
+    return load_replay(path, player_character, opponent_character)
+
+
+class ReplayCheckpoint:
+    """
+    Keeps the samples of every replay load_data has finished for one matchup in folder, one .npz per replay,
+    plus progress.json ({path: {'key': [size, mtime], 'file': name, 'rows': n, 'error': reason}}). A rerun
+    only loads replays that are new, changed or not done yet. A replay that is missing is recorded as a failure
+    with a key of None. Everything is dropped when the features or the characters change.
+    """
+
+    def __init__(self, folder: str, player_character: melee.Character, opponent_character: melee.Character):
+        self.folder = folder
+        self.progress_path = os.path.join(folder, 'progress.json')
+        self.setup = {'feature_versions': feature_versions, 'output_names': output_names,
+                      'characters': [player_character.name, opponent_character.name]}
+        self.replays = {}
+        self.unsaved = 0
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r') as file:
+                progress = json.load(file)
+            if progress['setup'] == self.setup:
+                self.replays = progress['replays']
+
+    def done(self, path: str) -> bool:
+        entry = self.replays.get(path)
+        if entry is None or entry['key'] != Files.file_key(path):
+            return False
+        return entry['file'] is None or os.path.exists(os.path.join(self.folder, entry['file']))
+
+    def error(self, path: str):
+        return self.replays[path]['error']
+
+    def _file(self, path: str) -> str:
+        return hashlib.sha1(path.encode()).hexdigest() + '.npz'
+
+    def add(self, path: str, result):
+        X, Y, source = result
+        name = self._file(path)
+        tmp_path = os.path.join(self.folder, name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, X=X.astype(np.float32), actions=Y,
+                     frames=source['player_frames'].astype(np.int32), hash=np.array(source['hash']),
+                     player_slot=np.array(source['player_slot']))
+        os.replace(tmp_path, os.path.join(self.folder, name))
+        self._record(path, {'file': name, 'rows': len(X), 'error': None})
+
+    def fail(self, path: str, error: str):
+        self._record(path, {'file': None, 'rows': 0, 'error': error})
+
+    def _record(self, path: str, entry: dict):
+        self.replays[path] = {'key': Files.file_key(path), **entry}
+        self.unsaved += 1
+        if self.unsaved >= 50:
+            self.save()
+
+    def load(self, path: str):
+        """Returns (X, action ids, frames, provenance info) of a replay added earlier"""
+        with np.load(os.path.join(self.folder, self.replays[path]['file'])) as data:
+            return data['X'], data['actions'], data['frames'], \
+                   {'hash': str(data['hash']), 'player_slot': int(data['player_slot'])}
+
+    def save(self):
+        Files.write_json(self.progress_path, {'setup': self.setup, 'replays': self.replays})
+        self.unsaved = 0
+
+
+def load_data(replay_paths: str, player_character: melee.Character, opponent_character: melee.Character,
+              path: str, workers: int = None, timeout: float = None, checkpoint: str = None,
+              chunk_rows: int = None) -> int:
+    """
+    Loads every replay of replay_paths on a pool of workers and writes the player's samples as the dataset at path,
+    chunk_rows rows at a time. With checkpoint (a folder), every finished replay is kept there as it comes in, and
+    replays finished by an earlier run are read back instead of loaded. Returns the number of rows written.
+    """
+    if workers is None:
+        workers = args.workers
+    if timeout is None:
+        timeout = args.replay_timeout
+    if chunk_rows is None:
+        chunk_rows = args.chunk_rows
+
+    progress = None
+    if checkpoint is not None:
+        progress = ReplayCheckpoint(checkpoint, player_character, opponent_character)
+    # Every replay is either read back from the checkpoint, missing or loaded
+    done = [progress is not None and progress.done(replay_path) for replay_path in replay_paths]
+    missing = [not d and Files.file_key(replay_path) is None for replay_path, d in zip(replay_paths, done)]
+    if progress is not None:
+        print(f'{sum(done)} of {len(replay_paths)} replays already done')
+
+    jobs = [(replay_path, player_character, opponent_character)
+            for replay_path, d, m in zip(replay_paths, done, missing) if not d and not m]
+    if workers > 1:
+        results = imap_with_timeout(_load_replay_job, jobs, workers, timeout)
+    else:
+        results = _serial_results(jobs, timeout)
+    results = _results_in_order(replay_paths, done, missing, results, progress)
+
+    failed = 0
+    with Dataset.DatasetWriter(path, chunk_rows, frames=True) as writer:
+        # Results come back in replay_paths order no matter which worker finished first
+        for job, result, error in tqdm(results, total=len(replay_paths)):
+            if error is not None:
+                failed += 1
+                print('failed to load', job[0], error, time.time())
+                continue
+            X, Y, source = result
+            with Timing.stage('write_dataset'):
+                writer.append(X, Y, source['player_frames'])
+            writer.add_replay(job[0], len(X), {'hash': source['hash'], 'player_slot': source['player_slot']})
+
+    if failed:
+        print(f'{failed} of {len(replay_paths)} replays failed to load')
+    return writer.rows
+
+
+def _results_in_order(replay_paths: list, done: list, missing: list, results, progress: ReplayCheckpoint):
+    """
+    Yields (job, result, error) for every replay of replay_paths in order, as soon as it is available. Done ones
+    are read back from progress, missing ones fail, the rest come from results and are saved to progress
+    before they are handed on. Timeouts are not saved, so the replay is tried again by the next run.
+    """
+    try:
+        for replay_path, d, m in zip(replay_paths, done, missing):
+            if d:
+                if progress.error(replay_path) is not None:
+                    yield (replay_path,), None, progress.error(replay_path)
+                    continue
+                with Timing.stage('read_checkpoint'):
+                    X, Y, frames, info = progress.load(replay_path)
+                yield (replay_path,), (X, Y, {**info, 'player_frames': frames}), None
+                continue
 
-    X_opponent = []
-    Y_oponnent = []
-    for path in tqdm(replay_paths):
-        console = melee.Console(is_dolphin=False,
-                                allow_old_version=True,
-                                path=path)
+            if m:
+                job, result, error = (replay_path,), None, 'replay is missing'
+            else:
+                job, result, error = next(results)
+            if progress is not None and not is_timeout(error):
+                with Timing.stage('checkpoint'):
+                    if error is not None:
+                        progress.fail(replay_path, error)
+                    else:
+                        progress.add(replay_path, result)
+            yield job, result, error
+    finally:
+        # Keep whatever was loaded, even if the run was interrupted
+        if progress is not None:
+            progress.save()
+
+
+def _serial_results(jobs: list, timeout: float = None):
+    """imap_with_timeout in this process, the timeout only holds where Workers.time_limit can enforce it"""
+    for job in jobs:
         try:
-            console.connect()
-        except:
-            console.stop()
-            print('console failed to connect', path, time.time())
-            continue
-
-        gamestate: melee.GameState = console.step()
-        player_port, opponent_port = get_ports(gamestate, player_character=player_character,
-                                               opponent_character=opponent_character)
-        if player_port == -1:
-            print('bad port', path, gamestate.players.keys(), time.time())
-
-            continue
-
-        player: melee.PlayerState = gamestate.players.get(player_port)
-        opponent: melee.PlayerState = gamestate.players.get(player_port)
-
-        player_action_history = deque(maxlen=3)
-        opponent_action_history = deque(maxlen=3)
-
-        last_recorded_player = player
-        last_recorded_action_player = -1
-
-        last_recorded_opponent = opponent
-        last_recorded_action_opponent = -1
-        while True:
-            try:
-                gamestate: melee.GameState = console.step()
-            except:
-                break
-            if gamestate is None or gamestate.stage is None:
-                break
-
-            player: melee.PlayerState = gamestate.players.get(player_port)
-            opponent: melee.PlayerState = gamestate.players.get(opponent_port)
-            if player is None or opponent is None:
-                break
-
-            if player.action in MovesList.dead_list:
-                continue
+            with time_limit(timeout):
+                result = _load_replay_job(job)
+        except JobTimeout as e:
+            yield job, None, str(e)
+        except Exception as e:
+            yield job, None, repr(e)
+        else:
+            yield job, result, None
 
-            # player
-            action = generate_output(player)
-            inp = generate_input(gamestate=gamestate, player_port=player_port, opponent_port=opponent_port)
-            if action is None:
-                break
-            if action not in [21, -1]:
-                player_action_history.append(action)
-                if action != last_recorded_action_player and action != -1:
-                    if player_action_history[-1] < 11 and player_action_history[0] >= 11:
-                        pass
-                    elif player_action_history[-1] >= 11 and player_action_history[0] < 11 or (
-                            player_action_history[-1] == player_action_history[0] and player_action_history[0] < 11):
-                        if controller_states_different(player, last_recorded_player):
-                            if inp is None:
-                                break
-
-                            out = np.zeros(21)
-                            out[action] = 1
-
-                            X_player.append(inp)
-                            Y_player.append(out)
-                        last_recorded_action_player = action
-                        last_recorded_player = player
-
-            #opponent
-            action_opponent = generate_output(player)
-            inp = generate_input(gamestate=gamestate, player_port=player_port, opponent_port=opponent_port)
-            if action_opponent is None:
-                break
-            if action_opponent not in [21, -1]:
-                opponent_action_history.append(action_opponent)
-                if action_opponent != last_recorded_action_opponent and action_opponent != -1:
-                    if opponent_action_history[-1] < 11 and opponent_action_history[0] >= 11:
-                        pass
-                    elif opponent_action_history[-1] >= 11 and opponent_action_history[0] < 11 or (
-                            opponent_action_history[-1] == opponent_action_history[0] and opponent_action_history[0] < 11):
-                        if controller_states_different(opponent, last_recorded_opponent):
-                            if inp is None:
-                                break
-
-                            out = np.zeros(21)
-                            out[action_opponent] = 1
-
-                            X_opponent.append(inp)
-                            Y_oponnent.append(out)
-                        last_recorded_action_opponent = action_opponent
-                        last_recorded_opponent = player
-
-    X_player = np.array(X_player)
-    Y_player = np.array(Y_player)
-    X_opponent = np.array(X_player)
-    Y_oponnent = np.array(Y_player)
-    return X_player, Y_player, X_opponent, Y_oponnent
 
-def process_replays(replays: dict, c1: melee.Character, c2: melee.Character, s: melee.Stage):
-    print(f'Data/{c1.name}_{c2.name}_on_{s.name}_data.pkl')
-    print(f'Data/{c2.name}_{c1.name}_on_{s.name}_data.pkl')
+def _inputs_signature(replay_paths: list) -> str:
+    """Changes whenever a replay is added, removed or modified, or the features change"""
+    inputs = [[path, Files.file_key(path)] for path in sorted(replay_paths)]
+    return hashlib.sha1(json.dumps([inputs, feature_versions, output_names]).encode()).hexdigest()
 
 
-    replay_paths = replays[f'{c1.name}_{c2.name}'][s.name]
-
-    Xp, Yp, Xo, Yo = load_data(replay_paths, c1, c2)
+def process_replays(replays: dict, c1: melee.Character, c2: melee.Character, s: melee.Stage):
+    player_path = Dataset.dataset_path(c1, c2, s)
+    opponent_path = Dataset.dataset_path(c2, c1, s)
+    print(player_path)
+    print(opponent_path)
 
-    data_file_path = f'Data/{c1.name}_{c2.name}_on_{s.name}_data.pkl'
-    with open(data_file_path, 'wb') as file:
-        pickle.dump({'X': Xp, 'Y': Yp}, file)
+    replay_paths = replays[f'{c1.name}_{c2.name}'][s.name]
 
-    data_file_path = f'Data/{c2.name}_{c1.name}_on_{s.name}_data.pkl'
-    with open(data_file_path, 'wb') as file:
-        pickle.dump({'X': Xo, 'Y': Yo}, file)
+    # A matchup whose replays haven't changed since its datasets were written is skipped
+    completed = {}
+    if os.path.exists(completed_path):
+        with open(completed_path, 'r') as file:
+            completed = json.load(file)
+    signature = _inputs_signature(replay_paths)
+    written = all(os.path.exists(os.path.join(path, Dataset.manifest_name)) for path in [player_path, opponent_path])
+    if written and completed.get(player_path) == signature:
+        print('Up to date, skipping')
+        return
+
+    checkpoint = os.path.join(checkpoint_folder, os.path.basename(player_path))
+    load_data(replay_paths, c1, c2, player_path, checkpoint=checkpoint)
+    # The opponent's dataset holds the same rows load_data built from the player's side
+    Dataset.copy_dataset(player_path, opponent_path)
+
+    completed[player_path] = signature
+    Files.write_json(completed_path, completed)
+
+
+def update_features(path: str, cache_folder: str = None) -> list:
+    """
+    Brings the X columns of the dataset at path up to date with DataHandler.input_features. Columns whose
+    version is unchanged are copied over, only added or changed ones are computed from the frame cache.
+    Returns the names of the recomputed columns.
+    """
+    if cache_folder is None:
+        cache_folder = args.frame_cache
+    dataset = Dataset.open_dataset(path)
+    stale = Dataset.stale_features(dataset)
+    if not stale and dataset.feature_schema == input_names:
+        return []
+    if stale and not (dataset.has_frames() and all('hash' in replay for replay in dataset.replays)):
+        raise ValueError(f'{path} does not record the frames its rows came from, run generate_data.py on it again')
+
+    # Written a replay (or, with nothing to recompute, a shard) at a time so memory doesn't grow with the dataset
+    if stale:
+        segments = [(replay['start'], replay['stop'], replay) for replay in dataset.replays]
+        if sum(stop - start for start, stop, _ in segments) != len(dataset):
+            raise ValueError(f'{path} has rows that came from no replay, run generate_data.py on it again')
+    else:
+        segments = [(start, min(start + Dataset.default_shard_rows, len(dataset)), None)
+                    for start in range(0, len(dataset), Dataset.default_shard_rows)]
+
+    old_columns = {name: i for i, name in enumerate(dataset.feature_schema)}
+    kept = [i for i, name in enumerate(input_names) if name not in stale]
+    columns = [input_names.index(name) for name in stale]
+    frames = dataset.frames() if dataset.has_frames() else None
+    writer = Dataset.DatasetWriter(path, x_dtype=dataset.X.dtype, frames=frames is not None,
+                                   weights=dataset.weighted, validation_start=dataset.manifest.get('validation_start'))
+    try:
+        for start, stop, replay in tqdm(segments):
+            if start == stop:
+                continue
+            X = np.empty((stop - start, len(input_names)), dtype=dataset.X.dtype)
+            X[:, kept] = dataset.X[start:stop][:, [old_columns[input_names[i]] for i in kept]]
+            if replay is not None:
+                raw = FrameCache.load(replay['path'], cache_folder)
+                if raw.replay_hash != replay['hash']:
+                    raise ValueError(f'{replay["path"]} changed since {path} was built')
+                rows = frames[start:stop]
+                player = _rows(raw.players[replay['player_slot']], rows)
+                opponent = _rows(raw.players[1 - replay['player_slot']], rows)
+                X[:, columns] = generate_input_batch(player, opponent, raw.stage, stale)
+            writer.append(X, dataset.action_ids(start, stop), None if frames is None else frames[start:stop],
+                          dataset.W[start:stop] if dataset.weighted else None)
+        for replay in dataset.replays:
+            info = {k: v for k, v in replay.items() if k not in ['path', 'start', 'stop']}
+            writer.add_replay(replay['path'], replay['stop'] - replay['start'], info)
+    except BaseException:
+        writer.abort()
+        raise
+    # Let go of the memory mapped shards before the dataset is replaced
+    del dataset
+    writer.close()
+    return stale
 
 
 if __name__ == '__main__':
+    if args.profile:
+        # Stages and the sampler only see this process, so load every replay in it
+        args.workers = 1
+        Timing.start_profiling(args.profile_output, args.profiler)
+
+    if args.rebuild_features:
+        # Only recompute the feature columns that changed, for every dataset already in Data/
+        for matchup in Dataset.find_datasets():
+            path = Dataset.load_dataset(*matchup).path
+            print(path, 'recomputed', update_features(path))
+        raise SystemExit
 
     # Mass Generate
     f = open('replays.json', 'r')
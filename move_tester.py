@@ -9,7 +9,7 @@ import os
 import DataHandler
 import numpy as np
 
-from DataHandler import controller_states_different, generate_input, generate_output, decode_from_model
+from DataHandler import controller_states_different, generate_input, generate_output, decode_from_model, snapshot
 
 from collections import deque
 
@@ -31,7 +31,8 @@ if __name__ == '__main__':
 
     action_history = deque(maxlen=3)
 
-    last_recorded_player = player
+    # Only the fields controller_states_different reads are kept, not the whole PlayerState
+    last_recorded_player = snapshot(player)
     last_recorded_action = -1
     while True:
         gamestate = game.get_gamestate()
@@ -51,9 +52,9 @@ if __name__ == '__main__':
                 if controller_states_different(player, last_recorded_player):
                     print(out)
                 last_recorded_action=out
-                last_recorded_player = player
+                last_recorded_player = snapshot(player)
 
         elif out == -1:
             last_recorded_action=out
-            last_recorded_player = player
+            last_recorded_player = snapshot(player)
 
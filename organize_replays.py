@@ -2,86 +2,97 @@ import os
 import json
 import time
 
-import melee
 from tqdm import tqdm
 
-if __name__ == '__main__':
-    # replay_folder = '/home/human/Documents/training_data'
-    replay_folder= '/home/human/Documents/slippi replays'
+import FrameCache
+from Files import file_key, write_json
+from Workers import imap_with_timeout, default_workers
+
+index_path = 'replay_index.json'
+replays_path = 'replays.json'
+# Parsed frames are kept here so generate_data.py doesn't have to parse the replays again
+frame_cache_folder = FrameCache.default_folder
+
+
+def index_replay(path: str):
+    """Returns {'characters': [p1, p2], 'stage': stage} for a usable replay, raises with the reason otherwise"""
+    frames = FrameCache.load(path, frame_cache_folder)
+
+    # Make sure the first player actually presses a button in one of the 1001 frames after the first
+    if not 1 <= frames.first_press[0] <= 1001:
+        raise RuntimeError('no button pressed')
+
+    p1, p2 = frames.characters()
+    return {'characters': [p1.name, p2.name], 'stage': frames.stage.name}
+
+
+def update_index(replay_folder: str, index: dict, workers: int, timeout: float):
+    """
+    Brings index ({path: {'key': [size, mtime], 'replay': info or None, 'error': reason}}) up to date with
+    replay_folder. Only files that are new or whose size or mtime changed are opened.
+    """
     replay_paths = []
     for root, dirs, files in os.walk(replay_folder):
         for name in files:
             replay_paths.append(os.path.join(root, name))
 
+    present = set(replay_paths)
+    folder = os.path.join(replay_folder, '')
+    for path in list(index):
+        if path.startswith(folder) and path not in present:
+            del index[path]
 
+    keys = {path: file_key(path) for path in replay_paths}
+    changed = [path for path in replay_paths if path not in index or index[path]['key'] != keys[path]]
+    print(f'{len(replay_paths)} replays, {len(changed)} new or changed')
 
-    if not os.path.exists('replays.json'):
-        with open('replays.json', 'w+') as file:
-            json.dump({}, file, indent=4)
+    for path, info, error in tqdm(imap_with_timeout(index_replay, changed, workers, timeout), total=len(changed)):
+        if error is not None:
+            print(error, path, time.time())
+        index[path] = {'key': keys[path], 'replay': info, 'error': error}
 
-    f = open('replays.json', 'r')
-    j = json.load(f)
 
-    for path in tqdm(replay_paths):
-        console = melee.Console(is_dolphin=False,
-                                allow_old_version=True,
-                                path=path)
-        try:
-            console.connect()
-        except:
-            console.stop()
-            print('console failed to connect', path,  time.time())
-            continue
-        gamestate: melee.GameState = console.step()
-
-        if gamestate is None:
-            print('gamestate is none', path,  time.time())
-            continue
-        
-        if gamestate.stage is None:
-            print('stage is none', path, time.time())
+def build_replays(index: dict) -> dict:
+    j = {}
+    for path in sorted(index):
+        info = index[path]['replay']
+        if info is None:
             continue
+        c1, c2 = info['characters']
+        stage = info['stage']
 
-        ports = list(gamestate.players.keys())
-
-        if len(ports) != 2:
-            print('not two ports ', path,  time.time())
-            continue
-        p1: melee.PlayerState = gamestate.players.get(ports[0])
-        p2: melee.PlayerState = gamestate.players.get(ports[1])
-
-        #Make sure button is actually pressed
-        button_pressed = False
-        counter = 0
-        while True:
-            counter += 1
-            gamestate: melee.GameState = console.step()
-            p1: melee.PlayerState = gamestate.players.get(ports[0])
-            controller: melee.ControllerState = p1.controller_state
-            for b in melee.enums.Button:
-                if controller.button.get(b):
-                    button_pressed = True
-                    break
-            if button_pressed or counter > 1000:
-                break
-        if not button_pressed:
-            continue
-
-        key = f'{p1.character.name}_{p2.character.name}'
+        key = f'{c1}_{c2}'
         if key not in j:
             j[key] = {}
-        if gamestate.stage.name not in j[key]:
-            j[key][gamestate.stage.name] = []
-        j[key][gamestate.stage.name].append(path)
-        
-        if p1.character.name != p2.character.name:
-            key = f'{p2.character.name}_{p1.character.name}'
+        if stage not in j[key]:
+            j[key][stage] = []
+        j[key][stage].append(path)
+
+        if c1 != c2:
+            key = f'{c2}_{c1}'
             if key not in j:
                 j[key] = {}
-            if gamestate.stage.name not in j[key]:
-                j[key][gamestate.stage.name] = []
-            j[key][gamestate.stage.name].append(path)
-        console.stop()
+            if stage not in j[key]:
+                j[key][stage] = []
+            j[key][stage].append(path)
+    return j
+
+
+if __name__ == '__main__':
+    # replay_folder = '/home/human/Documents/training_data'
+    replay_folder= '/home/human/Documents/slippi replays'
+    workers = default_workers()
+    timeout = 60
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+    try:
+        update_index(replay_folder, index, workers, timeout)
+    finally:
+        # Keep whatever was indexed, even if the run was interrupted
+        write_json(index_path, index)
 
-    with open('replays.json', 'w') as file:
-        json.dump(j, file, indent=2)
\ No newline at end of file
+    write_json(replays_path, build_replays(index))
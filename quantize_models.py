@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import json
+import os
+import time
+
+import numpy as np
+
+import Args
+import Dataset
+import Inference
+
+args = Args.get_args()
+
+folder = 'models2'
+
+
+def time_predict(model, x: np.ndarray, calls: int = 2000) -> float:
+    """Microseconds per predict call on x"""
+    model.predict(x)
+    start = time.perf_counter()
+    for _ in range(calls):
+        model.predict(x)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+if __name__ == '__main__':
+    # Quantizes every trained model and checks it against the float32 model on the rows train.py held out
+    report = {}
+    registries = {precision: Inference.ModelRegistry(folder, precision) for precision in Inference.precisions}
+    for matchup in Dataset.find_datasets():
+        name = Inference.model_name(*matchup)
+        if not os.path.exists(f'{folder}/{name}.npz') and not os.path.exists(f'{folder}/{name}.pkl'):
+            continue
+        dataset = Dataset.load_dataset(*matchup)
+        held_out = dataset.X[dataset.validation_start(args.validation_split):]
+        reference = registries['float32'].get(*matchup)
+        x = np.asarray(dataset.X[:1], dtype=np.float32)
+
+        report[name] = {'float32': {'weight_bytes': Inference.weight_bytes(reference),
+                                    'us_per_call': time_predict(reference, x)}}
+        for precision in Inference.quantized_precisions:
+            model = registries[precision].get(*matchup)
+            report[name][precision] = {**Inference.agreement(reference, model, held_out),
+                                       'weight_bytes': Inference.weight_bytes(model),
+                                       'us_per_call': time_predict(model, x)}
+            print(name, precision, f'{report[name][precision]["argmax_agreement"]:.2%} argmax agreement on',
+                  len(held_out), 'held out rows')
+
+    os.makedirs(folder, exist_ok=True)
+    with open(f'{folder}/quantization_report.json', 'w') as file:
+        json.dump(report, file, indent=2)
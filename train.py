@@ -10,6 +10,7 @@ from tqdm import tqdm
 import time
 import numpy as np
 
+import tensorflow as tf
 from tensorflow import keras
 from keras import optimizers
 from keras.models import Sequential
@@ -17,24 +18,81 @@ from keras.layers import Dense
 import pickle
 
 import Args
-from DataHandler import get_ports, controller_states_different, generate_input, generate_output
+import Dataset
+import Inference
+from DataHandler import get_ports, controller_states_different, generate_input, generate_output, input_names
 import MovesList
 
 args = Args.get_args()
 
 
-def create_model(X: np.ndarray, Y: np.ndarray, player_character: melee.Character, opponent_character: melee.Character,
+def make_pipeline(dataset: Dataset.ShardedDataset, start: int, stop: int, batch_size: int, shuffle: bool,
+                  shuffle_buffer: int, affine: tuple = None) -> tf.data.Dataset:
+    """
+    Streams rows start:stop of dataset from its memory mapped shards. Blocks of rows are read lazily, mixed in a
+    bounded shuffle buffer, batched and prefetched on tf.data's background threads while the model trains.
+    A compacted dataset also streams its row weights, which keras uses as sample_weight.
+    With affine, (scale, shift) from FeatureStats.affine, the observations are normalized as X * scale + shift.
+    """
+    signature = (tf.TensorSpec((None, dataset.X.shape[1]), tf.as_dtype(dataset.X.dtype)),
+                 tf.TensorSpec((None, dataset.Y.shape[1]), tf.as_dtype(dataset.Y.dtype)))
+    if dataset.weighted:
+        signature += (tf.TensorSpec((None,), tf.float32),)
+    data = tf.data.Dataset.from_generator(lambda: dataset.blocks(start, stop, shuffle=shuffle,
+                                                                 weights=dataset.weighted),
+                                          output_signature=signature)
+    if affine is not None:
+        scale, shift = (tf.constant(a, dtype=signature[0].dtype) for a in affine)
+        data = data.map(lambda x, *rest: (x * scale + shift, *rest))
+    data = data.unbatch()
+    if shuffle:
+        data = data.shuffle(shuffle_buffer)
+    return data.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def fold_normalization(model, scale: np.ndarray, shift: np.ndarray):
+    """
+    Folds X * scale + shift into the first Dense layer of model, which then takes the raw observations:
+    (x * scale + shift) @ W + b == x @ (scale[:, None] * W) + (shift @ W + b)
+    """
+    layer = model.layers[0]
+    kernel, bias = (w.astype(np.float64) for w in layer.get_weights())
+    layer.set_weights([(scale[:, None] * kernel).astype(np.float32), (shift @ kernel + bias).astype(np.float32)])
+
+
+def create_model(dataset: Dataset.ShardedDataset, player_character: melee.Character,
+                 opponent_character: melee.Character,
                  stage: melee.Stage,
-                 folder: str, lr: float):
-    print(len(X), len(Y))
-    print(len(X[0]), len(Y[0]))
+                 folder: str, lr: float, batch_size: int = 32, epochs: int = 1, validation_split: float = 0.1,
+                 shuffle_buffer: int = 1 << 16, normalize: bool = False):
+    stale = Dataset.stale_features(dataset)
+    if stale or dataset.feature_schema != input_names:
+        raise ValueError(f'{dataset.path} is out of date with DataHandler ({stale}), '
+                         'run generate_data.py --rebuild_features')
+    print(len(dataset.X), len(dataset.Y))
+    if dataset.weighted:
+        print(f'compacted, standing for {dataset.total_weight():.0f} samples')
+    print(dataset.X.shape[1], dataset.Y.shape[1])
+
+    # Standardize the observations with the dataset's statistics while training, then fold that into the first
+    # layer so the saved model takes the same raw observations as before
+    affine = dataset.feature_stats().affine() if normalize else None
+
+    train_rows = dataset.validation_start(validation_split)
+    validation_rows = len(dataset) - train_rows
+    train_data = make_pipeline(dataset, 0, train_rows, batch_size, shuffle=True, shuffle_buffer=shuffle_buffer,
+                               affine=affine)
+    validation_data = None
+    if validation_rows > 0:
+        validation_data = make_pipeline(dataset, train_rows, len(dataset), batch_size, shuffle=False,
+                                        shuffle_buffer=shuffle_buffer, affine=affine)
 
     # train
     model = Sequential([
-        Dense(128, activation='tanh', input_shape=(len(X[0]),)),
+        Dense(128, activation='tanh', input_shape=(dataset.X.shape[1],)),
         Dense(128, activation='tanh'),
         Dense(128, activation='tanh'),
-        Dense(len(Y[0]), activation='tanh'),
+        Dense(dataset.Y.shape[1], activation='tanh'),
     ])
     # model = Sequential([
     #     Dense(32, activation='tanh', input_shape=(len(X[0]),)),
@@ -68,30 +126,35 @@ def create_model(X: np.ndarray, Y: np.ndarray, player_character: melee.Character
     )
 
     model.fit(
-        X,  # training data
-        Y,  # training targets
-        shuffle=True
+        train_data,  # training data, targets and sample weights, shuffled by the pipeline
+        validation_data=validation_data,
+        epochs=epochs,
     )
+    if affine is not None:
+        fold_normalization(model, *affine)
 
     # folder = 'models'
     pickle_file_path = f'{folder}/{player_character.name}_v_{opponent_character.name}_on_{stage.name}.pkl'
 
-    if not os.path.isdir(folder):
-        os.mkdir(f'{folder}/')
+    os.makedirs(folder, exist_ok=True)
 
     with open(pickle_file_path, 'wb') as file:
         pickle.dump(model, file)
 
+    Inference.save_artifact(f'{folder}/{Inference.model_name(player_character, opponent_character, stage)}.npz',
+                            model, player_character=player_character.name,
+                            opponent_character=opponent_character.name, stage=stage.name,
+                            normalization='folded' if normalize else None)
+
 
 if __name__ == '__main__':
     player_character = melee.Character.MARTH
     opponent_character = melee.Character.CPTFALCON
     stage = melee.Stage.FINAL_DESTINATION
-    lr = 5e-5
-
-    raw = open(f'Data/{player_character.name}_{opponent_character.name}_on_{stage.name}_data.pkl', 'rb')
-    data = pickle.load(raw)
-    X = data['X']
-    Y = data['Y']
-    create_model(X, Y, player_character=player_character,
-                 opponent_character=opponent_character, stage=stage, folder='models2', lr=lr)
+    lr = args.lr
+
+    dataset = Dataset.load_dataset(player_character, opponent_character, stage)
+    create_model(dataset, player_character=player_character,
+                 opponent_character=opponent_character, stage=stage, folder='models2', lr=lr,
+                 batch_size=args.batch_size, epochs=args.epochs, validation_split=args.validation_split,
+                 shuffle_buffer=args.shuffle_buffer, normalize=args.normalize)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+import json
+import multiprocessing
+import os
+import time
+
+import Args
+import Dataset
+from Workers import default_workers
+
+args = Args.get_args()
+
+folder = 'models2'
+
+
+def _init_worker(threads: int):
+    # Must run before TensorFlow creates its thread pools, so every worker is pinned to its share of the cores
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _train_job(matchup):
+    import train
+
+    player_character, opponent_character, stage = matchup
+    start = time.time()
+    dataset = Dataset.load_dataset(player_character, opponent_character, stage)
+    train.create_model(dataset, player_character=player_character,
+                       opponent_character=opponent_character, stage=stage, folder=folder, lr=args.lr,
+                       batch_size=args.batch_size, epochs=args.epochs, validation_split=args.validation_split,
+                       shuffle_buffer=args.shuffle_buffer, normalize=args.normalize)
+    return {'rows': len(dataset), 'seconds': time.time() - start}
+
+
+if __name__ == '__main__':
+    matchups = Dataset.find_datasets()
+    cores = default_workers()
+    workers = args.train_workers or max(1, cores // 2)
+    workers = max(1, min(workers, len(matchups)))
+    threads = max(1, cores // workers)
+    print(f'Training {len(matchups)} models, {workers} at a time with {threads} threads each')
+
+    summary = {}
+    start = time.time()
+    # TensorFlow isn't fork safe, and a fresh process per model gives back its memory when it's done
+    context = multiprocessing.get_context('spawn')
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    with context.Pool(workers, initializer=_init_worker, initargs=(threads,), maxtasksperchild=1) as pool:
+        results = [(m, pool.apply_async(_train_job, (m,))) for m in matchups]
+        for (player_character, opponent_character, stage), result in results:
+            name = f'{player_character.name}_v_{opponent_character.name}_on_{stage.name}'
+            try:
+                summary[name] = result.get()
+                print(name, f'{summary[name]["seconds"]:.1f}s')
+            except Exception as e:
+                summary[name] = {'error': repr(e)}
+                print(name, 'failed', e)
+
+    os.makedirs(folder, exist_ok=True)
+    with open(f'{folder}/training_summary.json', 'w') as file:
+        json.dump({'wall_seconds': time.time() - start, 'workers': workers, 'threads': threads,
+                   'models': summary}, file, indent=2)
+    print(f'Trained {len(matchups)} models in {time.time() - start:.1f}s')